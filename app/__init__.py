@@ -8,6 +8,8 @@ app.config.from_envvar('ENV_DIRECTORY')
 jwt = JWTManager(app)
 
 db = SQLAlchemy(app)
-db.Model.metadata.reflect(bind=db.engine)
+from app import schema
+schema.load()
 
-from app import routes
\ No newline at end of file
+from app import routes
+schema.create_app_tables()
\ No newline at end of file
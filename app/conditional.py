@@ -0,0 +1,51 @@
+import hashlib
+import time
+from json import dumps
+
+from flask import Response, request
+from sqlalchemy import Integer, cast, func, select
+from werkzeug.http import quote_etag
+
+from app import app, db
+from app.streaming import json_serial
+
+
+def make_etag(*parts):
+    raw = dumps(parts, default=json_serial, sort_keys=True)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def fingerprint(statement, max_of=(), sum_of=()):
+    """Row count plus the max/sum of the given columns over statement's rows.
+
+    Also folds in the current ETAG_MAX_STALENESS window, so edits that
+    leave all of these unchanged still surface within that time.
+    """
+    columns = list(max_of) + list(sum_of)
+    rows = statement.with_only_columns(
+        *[column.label('c{}'.format(i)) for i, column in enumerate(columns)]
+    ).subquery()
+    aggregates = [func.count()]
+    for i in range(len(columns)):
+        column = rows.c['c{}'.format(i)]
+        if i < len(max_of):
+            aggregates.append(func.max(column))
+        else:
+            # MySQL sums integers to a DECIMAL
+            aggregates.append(cast(func.sum(column), Integer))
+
+    result = db.session.execute(select(*aggregates)).one()
+    window = int(time.time() // app.config['ETAG_MAX_STALENESS'])
+    return tuple(result) + (window,)
+
+
+def etag_headers(etag):
+    return {'ETag': quote_etag(etag)}
+
+
+def not_modified(etag):
+    """A 304 response if the client already holds etag, otherwise None"""
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=etag_headers(etag))
+    return None
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import delete, select, update
+
+from app import app, db
+from app.models import File, SensorFile, SensorFileHash
+
+
+def enabled():
+    return app.config['DEDUP_WINDOW'] != 0
+
+
+def find_duplicate(sensor_id, sha256):
+    """file_id of a file with this content uploaded to the sensor within
+    DEDUP_WINDOW seconds, or None. Files since moved to another sensor or
+    removed from Nextcloud don't count."""
+
+    if not enabled() or not sha256:
+        return None
+
+    statement = select(SensorFileHash.file_id)\
+        .join(SensorFile, SensorFile.file_id == SensorFileHash.file_id)\
+        .join(File, File.file_id == SensorFileHash.file_id)\
+        .filter(SensorFileHash.sensor_id == sensor_id)\
+        .filter(SensorFileHash.sha256 == sha256.lower())\
+        .filter(SensorFile.sensor_id == sensor_id)\
+        .order_by(SensorFileHash.uploaded_at.desc())\
+        .limit(1)
+    window = app.config['DEDUP_WINDOW']
+    if window is not None:
+        since = datetime.now() - timedelta(seconds=window)
+        statement = statement.filter(SensorFileHash.uploaded_at >= since)
+    return db.session.execute(statement).scalar()
+
+
+def remember(file_id, sensor_id, sha256, uploaded_at):
+    if enabled() and sha256:
+        db.session.add(SensorFileHash(
+            file_id=file_id, sensor_id=sensor_id, sha256=sha256,
+            uploaded_at=uploaded_at))
+
+
+def move_file(file_id, sensor_id):
+    db.session.execute(
+        update(SensorFileHash)
+        .where(SensorFileHash.file_id == file_id)
+        .values(sensor_id=sensor_id)
+        .execution_options(synchronize_session=False))
+
+
+def forget_files(file_ids):
+    db.session.execute(
+        delete(SensorFileHash)
+        .where(SensorFileHash.file_id.in_(file_ids))
+        .execution_options(synchronize_session=False))
+
+
+def forget_sensors(sensor_ids):
+    db.session.execute(
+        delete(SensorFileHash)
+        .where(SensorFileHash.sensor_id.in_(sensor_ids))
+        .execution_options(synchronize_session=False))
+
+
+@app.cli.command('prune-file-hashes')
+def prune_file_hashes():
+    """Drop file hashes that have fallen out of DEDUP_WINDOW."""
+
+    window = app.config['DEDUP_WINDOW']
+    if window is None:
+        return
+    result = db.session.execute(
+        delete(SensorFileHash)
+        .where(SensorFileHash.uploaded_at
+               < datetime.now() - timedelta(seconds=window))
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    click.echo('Removed {} file hashes'.format(result.rowcount))
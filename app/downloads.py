@@ -0,0 +1,179 @@
+import glob
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+from requests.auth import HTTPBasicAuth
+
+from app import app, nextcloud
+from app.metrics import Counter, phase
+
+# Headers of a Nextcloud download passed on to the client
+PROXIED_HEADERS = ('Content-Length', 'Content-Range', 'Accept-Ranges',
+                   'Last-Modified')
+
+lookups = Counter(
+    'elsdan_download_cache_lookups_total',
+    'Downloads looked up in the local cache, by whether a copy was found',
+    'result')
+
+# Bytes in the cache as of the last scan, plus what this worker has written
+# since; None until the first scan
+_cache_bytes = None
+_scanned_at = 0
+_cache_lock = threading.Lock()
+
+
+def cache_dir():
+    path = app.config['DOWNLOAD_CACHE_DIR']
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+def cache_enabled():
+    return app.config['DOWNLOAD_CACHE_MAX_BYTES'] > 0
+
+
+def cache_path(file_id, etag):
+    # The etag is part of the name, so a file changed in Nextcloud never
+    # matches its old copy. Etags are hex, but don't trust them in a path.
+    safe_etag = ''.join(c for c in etag or '' if c.isalnum())
+    return os.path.join(cache_dir(), '{}.{}'.format(file_id, safe_etag))
+
+
+def cached_copy(file_id, etag):
+    """Path of an up to date cached copy of a file, or None"""
+
+    if not cache_enabled() or not etag:
+        return None
+    path = cache_path(file_id, etag)
+    try:
+        # Touch it so that eviction sees it as recently used
+        os.utime(path)
+    except OSError:
+        lookups.inc('miss')
+        return None
+    lookups.inc('hit')
+    return path
+
+
+def evict(added=0):
+    """Count added bytes just written to the cache and, once it is over its
+    limit, remove least recently used copies until it fits.
+
+    The directory is only scanned then, or when the last scan is older than
+    DOWNLOAD_CACHE_RESCAN_INTERVAL: other workers' writes only show up in
+    this worker's total through a scan.
+    """
+    global _cache_bytes, _scanned_at
+
+    limit = app.config['DOWNLOAD_CACHE_MAX_BYTES']
+    with _cache_lock:
+        if _cache_bytes is not None and time.monotonic() - _scanned_at \
+                < app.config['DOWNLOAD_CACHE_RESCAN_INTERVAL']:
+            _cache_bytes += added
+            if _cache_bytes <= limit:
+                return
+        _cache_bytes = _evict(limit)
+        _scanned_at = time.monotonic()
+
+
+def _evict(limit):
+    # Returns the bytes left in the cache
+    entries = []
+    total = 0
+    for entry in os.scandir(cache_dir()):
+        if entry.name.endswith('.tmp') or not entry.is_file():
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+def webdav_url(uid, path):
+    # oc_filecache paths of home storages start with files/
+    relative = path[len('files/'):] if path.startswith('files/') else path
+    return '{}{}/{}'.format(
+        app.config['NEXTCLOUD_WEBDAV'], quote(uid), quote(relative))
+
+
+def open_download(uid, path, user, password, byte_range=None):
+    """Start a streamed WebDAV GET, returning the requests response"""
+
+    # Ask for the stored bytes as they are, so they can be cached and
+    # counted against Content-Length and Range
+    headers = {'Accept-Encoding': 'identity'}
+    if byte_range:
+        headers['Range'] = byte_range
+    with phase('webdav'):
+        return nextcloud.get(
+            webdav_url(uid, path),
+            auth=HTTPBasicAuth(user, password),
+            headers=headers,
+            stream=True)
+
+
+def stream_download(response, file_id, etag, size):
+    """Yield a WebDAV download a chunk at a time. A complete download of a
+    small enough file is written to the cache as it goes."""
+
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    cache = None
+    if cache_enabled() and etag and response.status_code == 200 \
+            and (size or 0) <= app.config['DOWNLOAD_CACHE_MAX_FILE_BYTES']:
+        fd, tmp = tempfile.mkstemp(dir=cache_dir(), suffix='.tmp')
+        cache = os.fdopen(fd, 'wb')
+
+    complete = False
+    written = 0
+    try:
+        for chunk in response.iter_content(chunk_size):
+            if cache:
+                cache.write(chunk)
+                written += len(chunk)
+            yield chunk
+        complete = True
+    finally:
+        response.close()
+        if cache:
+            cache.close()
+            if complete:
+                path = cache_path(file_id, etag)
+                os.replace(tmp, path)
+                # Older versions of the file can't be served any more
+                for old in glob.glob(os.path.join(
+                        cache_dir(), '{}.*'.format(file_id))):
+                    if old != path and not old.endswith('.tmp'):
+                        try:
+                            size = os.path.getsize(old)
+                            os.remove(old)
+                            written -= size
+                        except OSError:
+                            pass
+                evict(written)
+            else:
+                # The client went away or Nextcloud did, drop the partial copy
+                os.remove(tmp)
+
+
+def guess_mimetype(name):
+    mimetype, encoding = mimetypes.guess_type(name or '')
+    if encoding == 'gzip':
+        return 'application/gzip'
+    return mimetype or 'application/octet-stream'
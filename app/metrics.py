@@ -0,0 +1,240 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask_jwt_extended import verify_jwt_in_request
+
+from app import app
+
+# Phase recorded for the whole of every request
+TOTAL = 'total'
+# Endpoint label of phases timed outside a request, e.g. by spool workers
+BACKGROUND = 'background'
+
+
+class Histograms(object):
+    """Cumulative latency histograms keyed on (endpoint, phase)"""
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, phase, seconds):
+        with self._lock:
+            counts = self._data.get((endpoint, phase))
+            if counts is None:
+                # One count per bucket, then +Inf, then the sum
+                counts = self._data[(endpoint, phase)] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(counts) for key, counts in self._data.items()}
+
+
+class Counter(object):
+    """Prometheus counter with one label, served on /metrics alongside the
+    histograms once created"""
+
+    def __init__(self, name, documentation, label):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+        counters[name] = self
+
+    def inc(self, value, amount=1):
+        with self._lock:
+            self._values[value] = self._values.get(value, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+histograms = Histograms(app.config['METRICS_BUCKETS'])
+# Counter by metric name
+counters = {}
+_saved_at = 0
+
+
+def record(phase_name, seconds):
+    if has_request_context():
+        timings = g.setdefault('phase_timings', {})
+        timings[phase_name] = timings.get(phase_name, 0) + seconds
+    else:
+        histograms.observe(BACKGROUND, phase_name, seconds)
+
+
+@contextmanager
+def phase(name):
+    """Time a block as one phase of the current request. A phase entered
+    more than once in a request is reported as the sum."""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def jwt_required(optional=False, fresh=False, refresh=False, locations=None):
+    """flask_jwt_extended.jwt_required, timing the token check as 'jwt'"""
+
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            with phase('jwt'):
+                verify_jwt_in_request(optional, fresh, refresh, locations)
+            return current_app.ensure_sync(fn)(*args, **kwargs)
+        return decorator
+    return wrapper
+
+
+def endpoint_label():
+    if request.url_rule is None:
+        return '{} unmatched'.format(request.method)
+    return '{} {}'.format(request.method, request.url_rule.rule)
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    # Streamed bodies are still being sent at this point, so their total
+    # covers the first row but not the whole transfer
+    started = g.get('request_started')
+    if not app.config['METRICS_ENABLED'] or started is None:
+        return response
+
+    timings = dict(g.get('phase_timings', {}))
+    timings[TOTAL] = time.perf_counter() - started
+    endpoint = endpoint_label()
+    for name, seconds in timings.items():
+        histograms.observe(endpoint, name, seconds)
+
+    if app.config['METRICS_SERVER_TIMING']:
+        response.headers['Server-Timing'] = ', '.join(
+            '{};dur={:.1f}'.format(name, seconds * 1000)
+            for name, seconds in timings.items())
+
+    if app.config['METRICS_DIR']:
+        save()
+    return response
+
+
+def save():
+    """Write this worker's histograms and counters to METRICS_DIR, at most
+    once a second, so that /metrics on any worker can report all of them"""
+
+    global _saved_at
+
+    now = time.monotonic()
+    if now - _saved_at < 1:
+        return
+    _saved_at = now
+
+    directory = app.config['METRICS_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}.json'.format(os.getpid()))
+    with open(path + '.tmp', 'w') as f:
+        json.dump({
+            'histograms': [[endpoint, name, counts]
+                           for (endpoint, name), counts
+                           in histograms.snapshot().items()],
+            'counters': {name: counter.snapshot()
+                         for name, counter in counters.items()}
+        }, f)
+    os.replace(path + '.tmp', path)
+
+
+def _saved():
+    directory = app.config['METRICS_DIR']
+    save()
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            continue
+
+
+def collect():
+    """Histograms of this worker, or of every worker with METRICS_DIR set"""
+
+    if not app.config['METRICS_DIR']:
+        return histograms.snapshot()
+
+    merged = {}
+    for saved in _saved():
+        for endpoint, phase_name, counts in saved['histograms']:
+            total = merged.setdefault(
+                (endpoint, phase_name), [0] * len(counts))
+            for i, value in enumerate(counts):
+                total[i] += value
+    return merged
+
+
+def collect_counters():
+    """Counter values by metric name and label value, of this worker or of
+    every worker with METRICS_DIR set"""
+
+    if not app.config['METRICS_DIR']:
+        return {name: counter.snapshot()
+                for name, counter in counters.items()}
+
+    merged = {name: {} for name in counters}
+    for saved in _saved():
+        for name, values in saved['counters'].items():
+            total = merged.setdefault(name, {})
+            for value, count in values.items():
+                total[value] = total.get(value, 0) + count
+    return merged
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus_text():
+    metric = 'elsdan_request_phase_seconds'
+    lines = [
+        '# HELP {} Time spent in each phase of a request'.format(metric),
+        '# TYPE {} histogram'.format(metric)
+    ]
+    bounds = [str(bound) for bound in histograms.buckets] + ['+Inf']
+    for (endpoint, name), counts in sorted(collect().items()):
+        labels = 'endpoint="{}",phase="{}"'.format(
+            _label(endpoint), _label(name))
+        for bound, count in zip(bounds, counts):
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                metric, labels, bound, count))
+        lines.append('{}_sum{{{}}} {}'.format(metric, labels, counts[-1]))
+        lines.append('{}_count{{{}}} {}'.format(metric, labels, counts[-2]))
+
+    for name, values in sorted(collect_counters().items()):
+        counter = counters.get(name)
+        if counter is None:
+            continue
+        lines.append('# HELP {} {}'.format(name, counter.documentation))
+        lines.append('# TYPE {} counter'.format(name))
+        for value, count in sorted(values.items()):
+            lines.append('{}{{{}="{}"}} {}'.format(
+                name, counter.label, _label(value), count))
+    return '\n'.join(lines) + '\n'
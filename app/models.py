@@ -1,4 +1,5 @@
-from sqlalchemy import Boolean, Column, DateTime, Integer, String
+from sqlalchemy import (BigInteger, Boolean, Column, DateTime, Integer, String,
+                        and_, delete, exists, insert, select)
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.schema import ForeignKey
 
@@ -70,6 +71,17 @@ class Sensor(db.Model):
         return "<Sensor {} - {}>".format(self.sensor_id, self.sensor_name)
 
 
+class Storage(db.Model):
+    __tablename__ = 'oc_storages'
+    __table_args__ = {'extend_existing': True}
+
+    numeric_id = Column('numeric_id', Integer, primary_key=True)
+    storage_id = Column('id', String)
+
+    def __repr__(self):
+        return "<Storage {} - {}>".format(self.numeric_id, self.storage_id)
+
+
 tag_map = db.Table('oc_systemtag_object_mapping', db.Model.metadata,
     db.Column('objectid', db.Integer, db.ForeignKey('oc_filecache.fileid'), primary_key=True),
     db.Column('objecttype', db.String, default='files', primary_key=True),
@@ -78,20 +90,48 @@ tag_map = db.Table('oc_systemtag_object_mapping', db.Model.metadata,
 )
 
 
+def file_has_tag(file_id, tag_id):
+    return db.session.execute(select(exists().where(and_(
+        tag_map.c.objectid == file_id,
+        tag_map.c.objecttype == 'files',
+        tag_map.c.systemtagid == tag_id
+    )))).scalar()
+
+
+def add_file_tag(file_id, tag_id):
+    # Written straight to the mapping table so that tagging a file never
+    # has to load the tags it already has
+    db.session.execute(insert(tag_map).values(
+        objectid=file_id, objecttype='files', systemtagid=tag_id))
+
+
+def remove_file_tag(file_id, tag_id):
+    """Untag a file, returning whether it carried the tag"""
+
+    result = db.session.execute(delete(tag_map).where(
+        tag_map.c.objectid == file_id,
+        tag_map.c.objecttype == 'files',
+        tag_map.c.systemtagid == tag_id))
+    return result.rowcount > 0
+
+
 class File(db.Model):
     __tablename__ = 'oc_filecache'
     __table_args__ = {'extend_existing': True}
 
     file_id = Column('fileid', Integer, primary_key=True)
+    storage = Column('storage', ForeignKey('oc_storages.numeric_id'))
     path = Column('path', String)
+    path_hash = Column('path_hash', String)
     file_name = Column('name', String)
     mimetype = Column('mimetype', String)
+    size = Column('size', BigInteger)
     etag = Column('etag', String)
 
     tags = relationship(
         'Tag',
         secondary=tag_map, 
-        lazy='subquery',
+        lazy='select',
         backref=db.backref('files', lazy=True)
     )
 
@@ -118,3 +158,37 @@ class SensorFile(db.Model):
     upload_date = Column('upload_date', DateTime)
     sensor_id = Column('sensor_id', ForeignKey('sensors.sensor_id'))
 
+
+class SensorUploadStats(db.Model):
+    """Files and bytes uploaded per sensor per hour, kept up to date by
+    app/rollups.py alongside sensor_files"""
+
+    __tablename__ = 'sensor_upload_stats'
+    __table_args__ = {'extend_existing': True}
+
+    sensor_id = Column('sensor_id', ForeignKey('sensors.sensor_id'), primary_key=True)
+    bucket = Column('bucket', DateTime, primary_key=True)
+    file_count = Column('file_count', Integer, nullable=False, default=0)
+    byte_count = Column('byte_count', BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<SensorUploadStats {} - {}>".format(self.sensor_id, self.bucket)
+
+
+class SensorFileHash(db.Model):
+    """SHA-256 of each file uploaded to a sensor, used by app/dedup.py to
+    spot repeated uploads"""
+
+    __tablename__ = 'sensor_file_hashes'
+    __table_args__ = (
+        db.Index('ix_sensor_file_hashes_lookup', 'sensor_id', 'sha256', 'uploaded_at'),
+        {'extend_existing': True}
+    )
+
+    file_id = Column('fileid', ForeignKey('oc_filecache.fileid'), primary_key=True)
+    sensor_id = Column('sensor_id', ForeignKey('sensors.sensor_id'), nullable=False)
+    sha256 = Column('sha256', String(64), nullable=False)
+    uploaded_at = Column('uploaded_at', DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<SensorFileHash {} - {}>".format(self.file_id, self.sha256)
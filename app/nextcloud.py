@@ -0,0 +1,81 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app import app
+
+# One Session per worker process. Sessions are created lazily and keyed on
+# the pid so a Session opened before gunicorn forks is never shared.
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session, _session_pid
+
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=app.config['NEXTCLOUD_POOL_CONNECTIONS'],
+                pool_maxsize=app.config['NEXTCLOUD_POOL_MAXSIZE'],
+                pool_block=app.config['NEXTCLOUD_POOL_BLOCK'],
+                max_retries=app.config['NEXTCLOUD_MAX_RETRIES']
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Connection'] = 'keep-alive'
+            _session = session
+            _session_pid = os.getpid()
+    return _session
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', (
+        app.config['NEXTCLOUD_CONNECT_TIMEOUT'],
+        app.config['NEXTCLOUD_READ_TIMEOUT']
+    ))
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
+
+
+def pool_stats():
+    """Connection pool usage of this worker, one entry per Nextcloud host"""
+
+    stats = []
+    if _session is None or _session_pid != os.getpid():
+        return stats
+
+    # http:// and https:// share one adapter, hence one pool manager
+    pools = _session.get_adapter('http://').poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        stats.append(dict(
+            host=pool.host,
+            port=pool.port,
+            scheme=pool.scheme,
+            maxsize=pool.pool.maxsize if pool.pool else 0,
+            idle=pool.pool.qsize() if pool.pool else 0,
+            connections_opened=pool.num_connections,
+            requests_sent=pool.num_requests
+        ))
+    return stats
@@ -0,0 +1,41 @@
+import functools
+
+from flask import request
+from webargs.core import missing
+from webargs.flaskparser import parser
+
+
+@parser.location_loader('query_or_json')
+def load_query_or_json(request, schema):
+    """Arguments from the query string, overridden by any in a JSON body.
+
+    Read endpoints accept both so their responses can be cached by URL.
+    """
+    data = dict(parser.load_querystring(request, schema))
+    if request.get_data(cache=True):
+        json_data = parser.load_json(request, schema)
+        if json_data is not missing:
+            data.update(json_data)
+    return data
+
+
+def use_args_or_list(argmap, location='json'):
+    """use_args that also accepts a JSON array of argument objects.
+
+    The view receives a list of validated dicts when the body is an array
+    and a single dict otherwise. Validation errors of an array are reported
+    per index.
+    """
+    list_schema = parser.schema_class.from_dict(argmap)(many=True)
+
+    def decorator(func):
+        single = parser.use_args(argmap, location=location)(func)
+        many = parser.use_args(list_schema, location=location)(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if isinstance(request.get_json(silent=True), list):
+                return many(*args, **kwargs)
+            return single(*args, **kwargs)
+        return wrapper
+    return decorator
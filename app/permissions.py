@@ -0,0 +1,95 @@
+from collections import namedtuple
+
+from flask_jwt_extended import get_jwt_identity
+
+from app import app, db
+from app.cache import TTLCache
+from app.metrics import phase
+from app.models import Device, Sensor
+
+SensorAccess = namedtuple(
+    'SensorAccess', ['uid', 'device_id', 'is_enabled', 'datatype_id'])
+
+# Owner lookups for sensors and devices. Write endpoints of this worker
+# invalidate entries straight away; other workers converge within the TTL.
+ownership_cache = TTLCache(
+    maxsize=app.config['OWNERSHIP_CACHE_SIZE'],
+    ttl=app.config['OWNERSHIP_CACHE_TTL']
+)
+
+
+def sensor_access(sensor_id):
+    """Owner, device and enabled flag of a sensor, or None if it's missing"""
+
+    key = ('sensor', sensor_id)
+    access = ownership_cache.get(key)
+    if access is None:
+        with phase('permissions'):
+            row = db.session.query(
+                Device.uid, Sensor.device_id, Sensor.is_enabled,
+                Sensor.datatype_id
+            ).join(Sensor).filter(Sensor.sensor_id == sensor_id).first()
+        if row is None:
+            return None
+        access = SensorAccess(
+            row.uid, row.device_id, bool(row.is_enabled), row.datatype_id)
+        ownership_cache.set(key, access)
+    return access
+
+
+def device_owner(device_id):
+    """uid owning a device, or None if it's missing"""
+
+    key = ('device', device_id)
+    uid = ownership_cache.get(key)
+    if uid is None:
+        with phase('permissions'):
+            row = db.session.query(Device.uid)\
+                .filter(Device.device_id == device_id).first()
+        if row is None:
+            return None
+        uid = row.uid
+        ownership_cache.set(key, uid)
+    return uid
+
+
+def owns_sensor(sensor_id, uid=None, require_enabled=False):
+    access = sensor_access(sensor_id)
+    if access is None or access.uid != (uid or get_jwt_identity()):
+        return False
+    return access.is_enabled or not require_enabled
+
+
+def owns_device(device_id, uid=None):
+    owner = device_owner(device_id)
+    return owner is not None and owner == (uid or get_jwt_identity())
+
+
+def invalidate_sensor(sensor_id):
+    ownership_cache.pop(('sensor', sensor_id))
+
+
+def invalidate_device(device_id):
+    ownership_cache.pop(('device', device_id))
+    ownership_cache.pop_matching(
+        lambda key, value: key[0] == 'sensor' and value.device_id == device_id)
+
+
+def device_owners(device_ids):
+    """{device_id: uid} for those of device_ids that exist, in one query"""
+
+    if not device_ids:
+        return {}
+    rows = db.session.query(Device.device_id, Device.uid)\
+        .filter(Device.device_id.in_(device_ids)).all()
+    return {row.device_id: row.uid for row in rows}
+
+
+def sensor_owners(sensor_ids):
+    """{sensor_id: uid} for those of sensor_ids that exist, in one query"""
+
+    if not sensor_ids:
+        return {}
+    rows = db.session.query(Sensor.sensor_id, Device.uid).join(Device)\
+        .filter(Sensor.sensor_id.in_(sensor_ids)).all()
+    return {row.sensor_id: row.uid for row in rows}
@@ -0,0 +1,82 @@
+import threading
+import time
+
+from sqlalchemy import select
+
+from app import app, db
+from app.models import Datatype, Tag
+
+
+class TableCache(object):
+    """Per-worker copy of a small, rarely changing table.
+
+    Writes made through this worker call invalidate(), which bumps the
+    version and forces a reload on next use. Writes made by other workers
+    are picked up once the copy is older than ttl seconds.
+    """
+
+    def __init__(self, loader, ttl):
+        self.loader = loader
+        self.ttl = ttl
+        self.version = 0
+        self._rows = None
+        self._rows_version = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def rows(self):
+        with self._lock:
+            if (self._rows is None
+                    or self._rows_version != self.version
+                    or time.monotonic() - self._loaded_at > self.ttl):
+                self._rows = self.loader()
+                self._rows_version = self.version
+                self._loaded_at = time.monotonic()
+            return self._rows
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._rows = None
+
+
+def name_matches(name, value, match='contains'):
+    name = (name or '').casefold()
+    value = value.casefold()
+    if match == 'exact':
+        return name == value
+    if match == 'prefix':
+        return name.startswith(value)
+    return value in name
+
+
+def filter_rows(rows, args, match='contains'):
+    """Apply the GET arguments of a reference table to its cached rows.
+
+    Like the SQL filters they replace, *name arguments match substrings (or
+    prefixes, or whole names, depending on match) case-insensitively and
+    everything else must be equal.
+    """
+    matches = []
+    for row in rows:
+        for column_name, value in args.items():
+            if 'name' in column_name:
+                if not name_matches(row[column_name], value, match):
+                    break
+            elif row[column_name] != value:
+                break
+        else:
+            matches.append(dict(row))
+    return matches
+
+
+datatypes = TableCache(
+    lambda: [d.to_dict() for d in Datatype.query.all()],
+    ttl=app.config['REFDATA_CACHE_TTL']
+)
+
+tags = TableCache(
+    lambda: [row._asdict() for row in
+             db.session.execute(select(Tag.tag_id, Tag.tag_name))],
+    ttl=app.config['REFDATA_CACHE_TTL']
+)
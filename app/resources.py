@@ -1,21 +1,43 @@
-from datetime import date, datetime
-import time
-from json import dumps
+import base64
+import binascii
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from json import dumps, loads
 
 import requests
-from flask import request, Response
-from flask_jwt_extended import get_jwt_identity, jwt_required
+
+from flask import Response, abort, request, send_file
+from flask_jwt_extended import get_jwt_identity
 from flask_restful import Resource
-from requests.models import HTTPBasicAuth
-from sqlalchemy import inspect, select
+from sqlalchemy import (String, and_, cast, delete, func, insert, inspect,
+                        literal, or_, select)
 from sqlalchemy.exc import SQLAlchemyError
 # webargs to extract and validate arguments in HTTP requests
-from webargs import fields
+from webargs import fields, validate
 from webargs.flaskparser import use_args
-
-from app import app, db
-from app.models import (Datatype, Device, File, Sensor,
-                        SensorFile, Tag)
+from werkzeug.exceptions import BadRequest
+
+from app import app, db, dedup, downloads, refdata, rollups, search, spool
+# Registers the 'query_or_json' webargs location used by read endpoints
+from app import parsing
+from app.parsing import use_args_or_list
+from app.metrics import jwt_required, phase
+from app.conditional import (etag_headers, fingerprint, make_etag,
+                             not_modified)
+from app.models import (Datatype, Device, File, Sensor, SensorFile,
+                        SensorUploadStats, Tag, add_file_tag, file_has_tag,
+                        remove_file_tag, tag_map)
+from app.permissions import (device_owner, device_owners, invalidate_device,
+                             invalidate_sensor, owns_device, owns_sensor,
+                             sensor_access, sensor_owners)
+from app.streaming import json_list_response, peek, stream_rows
+from app.uploads import (DecodingStream, UploadStream, buffer_body,
+                         check_sha256, find_uploaded_file, gzipped,
+                         link_duplicate, push_to_nextcloud, put_to_nextcloud,
+                         record_sensor_file, remove_from_nextcloud,
+                         sha256_of, store_compressed, supported_encodings,
+                         with_length)
 
 resp_msg = {
     'INSERT': "{} added successfully",
@@ -25,25 +47,198 @@ resp_msg = {
     'NO_ITEM': "No item satisfies your arguments"
 }
 
-def json_serial(obj):
-    """JSON serializer for objects not serializable by default json code"""
+# How *_name, location and tag_name filters compare. 'prefix' and 'exact'
+# can use the B-tree indexes on those columns, 'contains' can't.
+match_arg = fields.Str(
+    missing='contains',
+    validate=validate.OneOf(['contains', 'prefix', 'exact']))
+
 
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError ("Type %s not serializable" % type(obj))
+def name_filter(column, value, match='contains'):
+    if match == 'exact':
+        return column == value
+    if match == 'prefix':
+        return column.startswith(value, autoescape=True)
+    return column.contains(value)
 
 
 def get_sensor_permission(sensor_id):
-    (uid,) = db.session.query(Device.uid).join(Sensor)\
-            .filter(Sensor.sensor_id == sensor_id).first()
-    if uid != get_jwt_identity():
-        return False
-    return True
+    return owns_sensor(sensor_id)
+
+
+def too_many_items(items):
+    if len(items) > app.config['BULK_MAX_ITEMS']:
+        return {"msg": "Too many items in one request (>{})".format(
+            app.config['BULK_MAX_ITEMS'])}, 400
+    return None
+
+
+def bulk_write(model, results, inserts=(), updates=()):
+    """Write all accepted items of a bulk request in one transaction.
+
+    results holds one dict per item; those not already marked as failed
+    are marked as failed too if the transaction can't be committed.
+    inserts holds (result, mapping) pairs, and each of those results gets
+    the primary key of the row inserted for it.
+    """
+    if inserts:
+        # return_defaults fills the new primary keys into the mappings
+        db.session.bulk_insert_mappings(
+            model, [mapping for result, mapping in inserts],
+            return_defaults=True)
+    if updates:
+        db.session.bulk_update_mappings(model, updates)
+
+    try:
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        for result in results:
+            if result['status'] < 400:
+                result.update(status=500, msg=str(e.__dict__['orig']))
+        return {"results": results}, 200
+
+    key = inspect(model).primary_key[0].key
+    for result, mapping in inserts:
+        result[key] = mapping[key]
+    return {"results": results}, 200
+
+
+def delete_device_cascade(device_id, delete_tags=False):
+    """Delete a device with its sensors and their sensor_files rows.
+
+    Devices with at most DELETE_BATCH_SIZE files go in one transaction.
+    Larger ones have their files removed in committed batches first, so
+    no single transaction holds locks over all of them. With delete_tags,
+    the tag mappings of those files are removed too. The files themselves
+    stay in Nextcloud.
+    """
+    batch_size = app.config['DELETE_BATCH_SIZE']
+    device_sensors = select(Sensor.sensor_id)\
+        .filter(Sensor.device_id == device_id)
+
+    while True:
+        file_ids = db.session.execute(
+            select(SensorFile.file_id)
+            .filter(SensorFile.sensor_id.in_(device_sensors))
+            .limit(batch_size)
+        ).scalars().all()
+        if not file_ids:
+            break
+
+        dedup.forget_files(file_ids)
+        if delete_tags:
+            db.session.execute(delete(tag_map).where(
+                tag_map.c.objectid.in_(file_ids),
+                tag_map.c.objecttype == 'files'))
+        db.session.execute(
+            delete(SensorFile).where(SensorFile.file_id.in_(file_ids))
+            .execution_options(synchronize_session=False))
+
+        if len(file_ids) < batch_size:
+            break
+        db.session.commit()
+
+    rollups.forget_sensors(device_sensors)
+    db.session.execute(
+        delete(Sensor).where(Sensor.device_id == device_id)
+        .execution_options(synchronize_session=False))
+    db.session.execute(
+        delete(Device).where(Device.device_id == device_id)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+
+
+def filter_files(statement, args):
+    """Apply the file filters of /api/filedetail to a statement that
+    selects from File joined to SensorFile and Sensor"""
+
+    statement = statement.filter(File.path.startswith('files/'))\
+        .filter(File.mimetype > 2)
+
+    if 'tag_id' in args or 'tag_name' in args:
+        statement = statement.join(File.tags)
+        if 'tag_id' in args:
+            statement = statement.filter(Tag.tag_id == args['tag_id'])
+        if 'tag_name' in args:
+            statement = statement.filter(name_filter(
+                Tag.tag_name, args['tag_name'], args.get('match', 'contains')))
+    if 'file_id' in args:
+        statement = statement.filter(File.file_id == args['file_id'])
+    if 'file_ids' in args:
+        statement = statement.filter(File.file_id.in_(args['file_ids']))
+    if 'sensor_id' in args:
+        statement = statement.filter(Sensor.sensor_id == args['sensor_id'])
+    if 'device_id' in args:
+        statement = statement.filter(Sensor.device_id == args['device_id'])
+    if 'datatype_id' in args:
+        statement = statement.filter(
+            Sensor.datatype_id == args['datatype_id'])
+    if 'topic' in args:
+        statement = statement.filter(Sensor.topic == args['topic'])
+    if 'start_date' in args:
+        statement = statement.filter(
+            SensorFile.upload_date > args['start_date'])
+    if 'end_date' in args:
+        statement = statement.filter(
+            SensorFile.upload_date < args['end_date'])
+    return statement
+
+
+def file_tags():
+    """Tags of the File row in the enclosing query, as comma separated
+    id:name pairs. Names are hex encoded so that any commas or colons in
+    them survive; parse_file_tags() reads them back."""
+
+    return select(func.group_concat(
+        cast(tag_map.c.systemtagid, String) + ':' + func.hex(Tag.tag_name)
+    )).select_from(
+        tag_map.join(Tag, Tag.tag_id == tag_map.c.systemtagid)
+    ).where(
+        tag_map.c.objectid == File.file_id,
+        tag_map.c.objecttype == 'files'
+    ).scalar_subquery()
+
+
+def parse_file_tags(value):
+    tags = []
+    for pair in value.split(',') if value else []:
+        tag_id, name = pair.split(':')
+        tags.append(dict(
+            tag_id=int(tag_id),
+            tag_name=bytes.fromhex(name).decode('utf-8')))
+    return sorted(tags, key=lambda tag: tag['tag_id'])
+
+
+def file_tag_count():
+    return select(func.count()).where(
+        tag_map.c.objectid == File.file_id,
+        tag_map.c.objecttype == 'files'
+    ).scalar_subquery()
 
 
 def file_namer(sensor_id, extension):
+    # The timestamp only has seconds; the uuid keeps uploads of the same
+    # second from overwriting each other
     now = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-    return "{}_sensor_{}.{}".format(now, sensor_id, extension)
+    return "{}_sensor_{}_{}.{}".format(
+        now, sensor_id, uuid.uuid4().hex, extension)
+
+
+def encode_cursor(upload_date, file_id):
+    raw = dumps([upload_date.isoformat(), file_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Return the (upload_date, file_id) a cursor points at, or None"""
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        upload_date, file_id = loads(raw.decode('utf-8'))
+        return datetime.fromisoformat(upload_date), int(file_id)
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        return None
 
 
 def append_slash(dir):
@@ -83,30 +278,23 @@ class DatatypeResource(Resource):
     get_args = {
         'datatype_id': fields.Int(),
         'datatype_name': fields.Str(),
-        'is_large': fields.Bool()
+        'is_large': fields.Bool(),
+        'match': match_arg
     }
 
-    @use_args(get_args, location='json')
+    @use_args(get_args, location='query_or_json')
     @jwt_required()
     def get(self, get_args):
-        statement = select(Datatype)
-        # Filter by each parameter given in args
-        # Equivalent to WHERE ... AND clauses
-        for column_name in get_args:
-            if 'name' in column_name:
-                statement = statement.filter(
-                    getattr(Datatype, column_name).contains(get_args[column_name])
-                )
-            else:
-                statement = statement.filter(
-                    getattr(Datatype, column_name) == get_args[column_name]
-                )
-        rows = db.session.execute(statement)
+        # Datatypes are served from the per-worker reference data cache
+        match = get_args.pop('match')
+        rows = refdata.filter_rows(
+            refdata.datatypes.rows(), get_args, match)
 
         if not rows:
             return {"msg": resp_msg['NO_ITEM']}, 404
 
-        return [row.to_dict() for (row,) in rows]
+        etag = make_etag('datatype', rows)
+        return not_modified(etag) or (rows, 200, etag_headers(etag))
 
     
     post_args = {
@@ -130,6 +318,7 @@ class DatatypeResource(Resource):
             return {
                 "msg": str(e.__dict__['orig'])
             }, 500
+        refdata.datatypes.invalidate()
         
         return {
             "msg": resp_msg['INSERT'].format(datatype)
@@ -161,6 +350,7 @@ class DatatypeResource(Resource):
             return {
                 "msg": str(e.__dict__['orig'])
             }, 500
+        refdata.datatypes.invalidate()
         
         return {
             "msg": resp_msg['UPDATE'].format(datatype)
@@ -172,28 +362,39 @@ class DeviceResource(Resource):
         'device_id': fields.Int(),
         'device_name': fields.Str(),
         'location': fields.Str(),
-        'uid': fields.Str()
+        'uid': fields.Str(),
+        'match': match_arg
     }
 
-    @use_args(get_args, location='json')
+    @use_args(get_args, location='query_or_json')
     @jwt_required()
     def get(self, get_args):
+        filters = dict(get_args)
+        match = get_args.pop('match')
         statement = select(Device)
         for column_name in get_args:
             if 'name' in column_name:
-                statement = statement.filter(
-                    getattr(Device, column_name).contains(get_args[column_name])
-                )
+                statement = statement.filter(name_filter(
+                    getattr(Device, column_name), get_args[column_name], match
+                ))
             else:
                 statement = statement.filter(
                     getattr(Device, column_name) == get_args[column_name]
                 )
-        rows = db.session.execute(statement).all()
 
-        if not rows:
+        etag = make_etag('device', filters, fingerprint(
+            statement, max_of=[Device.device_id]))
+        response = not_modified(etag)
+        if response:
+            return response
+
+        first, rows = peek(stream_rows(statement))
+
+        if first is None:
             return {"msg": resp_msg['NO_ITEM']}, 404
 
-        return [row.to_dict() for (row,) in rows]
+        return json_list_response(
+            rows, lambda row: row[0].to_dict(), headers=etag_headers(etag))
     
 
     post_args = {
@@ -201,11 +402,22 @@ class DeviceResource(Resource):
         'location': fields.Str(required=True)
     }
 
-    @use_args(post_args, location='json')
+    @use_args_or_list(post_args, location='json')
     @jwt_required()
     def post(self, post_args):
         uid = get_jwt_identity()
 
+        if isinstance(post_args, list):
+            error = too_many_items(post_args)
+            if error:
+                return error
+            results = [dict(index=i, status=201)
+                       for i in range(len(post_args))]
+            return bulk_write(
+                Device, results,
+                inserts=[(result, dict(item, uid=uid))
+                         for result, item in zip(results, post_args)])
+
         device = Device(uid=uid)
         
         for column_name in post_args:
@@ -231,17 +443,26 @@ class DeviceResource(Resource):
         'location': fields.Str()
     }
 
-    @use_args(patch_args, location='json')
+    @use_args_or_list(patch_args, location='json')
     @jwt_required()
     def patch(self, patch_args):
+        if isinstance(patch_args, list):
+            return self.bulk_patch(patch_args)
+
         id = patch_args.pop('device_id')
         
+        owner = device_owner(id)
+        if not owner:
+            return {"msg": resp_msg['NO_ITEM']}, 404
+        if owner != get_jwt_identity():
+            return {"msg": resp_msg['NO_PERMISSION']}, 403
+
         device = db.session.query(Device)\
             .filter(Device.device_id == id).first()
         if not device:
+            # Deleted by another worker since its owner was cached
+            invalidate_device(id)
             return {"msg": resp_msg['NO_ITEM']}, 404
-        if device.uid != get_jwt_identity():
-            return {"msg": resp_msg['NO_PERMISSION']}, 403
 
         for column_name in patch_args:
             setattr(device, column_name, patch_args[column_name])
@@ -258,9 +479,39 @@ class DeviceResource(Resource):
             "msg": resp_msg['UPDATE'].format(device)
         }, 200
 
+    def bulk_patch(self, items):
+        error = too_many_items(items)
+        if error:
+            return error
+
+        uid = get_jwt_identity()
+        owners = device_owners({item['device_id'] for item in items})
+
+        results = []
+        updates = []
+        for index, item in enumerate(items):
+            owner = owners.get(item['device_id'])
+            if not owner:
+                results.append(dict(
+                    index=index, status=404, msg=resp_msg['NO_ITEM']))
+            elif owner != uid:
+                results.append(dict(
+                    index=index, status=403, msg=resp_msg['NO_PERMISSION']))
+            else:
+                results.append(dict(index=index, status=200))
+                if len(item) > 1:
+                    updates.append(item)
+
+        try:
+            return bulk_write(Device, results, updates=updates)
+        finally:
+            for item in updates:
+                invalidate_device(item['device_id'])
+
     
     del_args ={
-        'device_id': fields.Int(required=True)
+        'device_id': fields.Int(required=True),
+        'delete_tags': fields.Bool(missing=False)
     }
 
     @use_args(del_args, location='json')
@@ -268,30 +519,32 @@ class DeviceResource(Resource):
     def delete(self, del_args):
         id = del_args['device_id']
         
+        owner = device_owner(id)
+        if not owner:
+            return {"msg":resp_msg['NO_ITEM']}, 404
+        if owner != get_jwt_identity():
+            return {"msg": resp_msg['NO_PERMISSION']}, 403
+
         device = db.session.query(Device)\
             .filter(Device.device_id == id).first()
         if not device:
+            invalidate_device(id)
             return {"msg":resp_msg['NO_ITEM']}, 404
-        if device.uid != get_jwt_identity():
-            return {"msg": resp_msg['NO_PERMISSION']}, 403
-        
-         # Delete all sensors attached to the device
-        device_sensors = Sensor.query.filter(Sensor.device_id == id).all()
-        for sensor in device_sensors:
-            db.session.delete(sensor)
+        # The rows go away underneath the session, so format it now
+        msg = resp_msg['DELETE'].format(device)
 
         try:
-            db.session.commit()
-            db.session.delete(device)
-            db.session.commit()
+            delete_device_cascade(id, del_args['delete_tags'])
         except SQLAlchemyError as e:
             db.session.rollback()
             return {
                 "msg": str(e.__dict__['orig'])
             }, 500
+        finally:
+            invalidate_device(id)
         
         return {
-            "msg": resp_msg['DELETE'].format(device)
+            "msg": msg
         }, 200
 
 
@@ -307,12 +560,16 @@ class SensorResource(Resource):
         'datatype_name': fields.Str(),
         'is_large': fields.Bool(),
         'uid': fields.Str(),
-        'device_name': fields.Str()
+        'device_name': fields.Str(),
+        'match': match_arg
     }
 
-    @use_args(get_args, location='json')
+    @use_args(get_args, location='query_or_json')
     @jwt_required()
     def get(self, get_args):
+        # Filters are popped off get_args below, keep them for the ETag
+        filters = dict(get_args)
+        match = get_args.pop('match')
         statement = select(
             Sensor.sensor_id,
             Sensor.sensor_name,
@@ -328,10 +585,9 @@ class SensorResource(Resource):
         ).join(Datatype).join(Device)
 
         if 'datatype_name' in get_args:
-            statement = statement.filter(
-                Datatype.datatype_name.contains(
-                    get_args.pop('datatype_name'))
-            )
+            statement = statement.filter(name_filter(
+                Datatype.datatype_name, get_args.pop('datatype_name'), match
+            ))
         if 'is_large' in get_args:
             statement = statement.filter(
                 Datatype.is_large == get_args.pop('is_large'))
@@ -339,29 +595,36 @@ class SensorResource(Resource):
             statement = statement.filter(
                 Device.uid == get_args.pop('uid'))
         if 'device_name' in get_args:
-            statement = statement.filter(
-                Device.device_name.contains(get_args.pop('device_name')))
+            statement = statement.filter(name_filter(
+                Device.device_name, get_args.pop('device_name'), match))
         if 'location' in get_args:
-            statement = statement.filter(
-                Device.location.contains(get_args.pop('location')))
+            statement = statement.filter(name_filter(
+                Device.location, get_args.pop('location'), match))
 
         # Filter by each parameter given in args
         # Equivalent to WHERE ... AND clauses
         for column_name in get_args:
             if 'name' in column_name:
-                statement = statement.filter(
-                    getattr(Sensor, column_name).contains(get_args[column_name])
-                )
+                statement = statement.filter(name_filter(
+                    getattr(Sensor, column_name), get_args[column_name], match
+                ))
             else:
                 statement = statement.filter(
                     getattr(Sensor, column_name) == get_args[column_name])
 
-        rows = db.session.execute(statement).all()
+        etag = make_etag('sensor', filters, fingerprint(
+            statement, max_of=[Sensor.sensor_id]))
+        response = not_modified(etag)
+        if response:
+            return response
 
-        if not rows:
+        first, rows = peek(stream_rows(statement))
+
+        if first is None:
             return {"msg": resp_msg['NO_ITEM']}, 404
 
-        return [row._asdict() for row in rows]
+        return json_list_response(
+            rows, lambda row: row._asdict(), headers=etag_headers(etag))
     
 
     post_args = {
@@ -372,14 +635,15 @@ class SensorResource(Resource):
         'device_id': fields.Int(required=True)
     }
 
-    @use_args(post_args, location='json')
+    @use_args_or_list(post_args, location='json')
     @jwt_required()
     def post(self, post_args):
         uid = get_jwt_identity()
-        device = Device.query.filter_by(
-            device_id=post_args['device_id']
-        ).first()
-        if not device or device.uid != uid:
+
+        if isinstance(post_args, list):
+            return self.bulk_post(post_args, uid)
+
+        if not owns_device(post_args['device_id'], uid):
             return {
                 "msg": "Target device doesn't exist or you don't own it"
             }, 400
@@ -402,6 +666,27 @@ class SensorResource(Resource):
             "msg": resp_msg['INSERT'].format(sensor)
         }, 201
 
+    def bulk_post(self, items, uid):
+        error = too_many_items(items)
+        if error:
+            return error
+
+        owners = device_owners({item['device_id'] for item in items})
+
+        results = []
+        inserts = []
+        for index, item in enumerate(items):
+            if owners.get(item['device_id']) != uid:
+                results.append(dict(
+                    index=index, status=400,
+                    msg="Target device doesn't exist or you don't own it"))
+            else:
+                result = dict(index=index, status=201)
+                results.append(result)
+                inserts.append((result, item))
+
+        return bulk_write(Sensor, results, inserts=inserts)
+
 
     patch_args = {
         'sensor_id': fields.Int(required=True),
@@ -412,30 +697,34 @@ class SensorResource(Resource):
         'device_id': fields.Int()
     }
 
-    @use_args(patch_args, location='json')
+    @use_args_or_list(patch_args, location='json')
     @jwt_required()
     def patch(self, patch_args):
         uid = get_jwt_identity()
+
+        if isinstance(patch_args, list):
+            return self.bulk_patch(patch_args, uid)
+
         id = patch_args.pop('sensor_id')
         
         if 'device_id' in patch_args:
-            device = Device.query.filter_by(
-                device_id=patch_args['device_id']
-            ).first()
-            if not device or device.uid != uid:
+            if not owns_device(patch_args['device_id'], uid):
                 return {
                     "msg": "Target device doesn't exist or you don't own it"
                 }, 400
 
-        sensor = Sensor.query.filter_by(sensor_id=id).first()
-        if not sensor:
+        access = sensor_access(id)
+        if not access:
             return{"msg": resp_msg['NO_ITEM']}, 404
-        
-        master_device = Device.query.filter_by(
-            device_id=sensor.device_id).first()
-        if master_device.uid != uid:
+        if access.uid != uid:
             return {"msg": resp_msg["NO_PERMISSION"]}, 403
         
+        sensor = Sensor.query.filter_by(sensor_id=id).first()
+        if not sensor:
+            # Deleted by another worker since its owner was cached
+            invalidate_sensor(id)
+            return{"msg": resp_msg['NO_ITEM']}, 404
+
         for column_name in patch_args:
             setattr(sensor, column_name, patch_args[column_name])
 
@@ -446,11 +735,48 @@ class SensorResource(Resource):
             return {
                 "msg": str(e.__dict__['orig'])
             }, 500
+        finally:
+            invalidate_sensor(id)
         
         return {
             "msg": resp_msg['UPDATE'].format(sensor)
         }, 200
 
+    def bulk_patch(self, items, uid):
+        error = too_many_items(items)
+        if error:
+            return error
+
+        owners = sensor_owners({item['sensor_id'] for item in items})
+        device_ids = {item['device_id'] for item in items
+                      if 'device_id' in item}
+        targets = device_owners(device_ids)
+
+        results = []
+        updates = []
+        for index, item in enumerate(items):
+            owner = owners.get(item['sensor_id'])
+            if 'device_id' in item and targets.get(item['device_id']) != uid:
+                results.append(dict(
+                    index=index, status=400,
+                    msg="Target device doesn't exist or you don't own it"))
+            elif not owner:
+                results.append(dict(
+                    index=index, status=404, msg=resp_msg['NO_ITEM']))
+            elif owner != uid:
+                results.append(dict(
+                    index=index, status=403, msg=resp_msg['NO_PERMISSION']))
+            else:
+                results.append(dict(index=index, status=200))
+                if len(item) > 1:
+                    updates.append(item)
+
+        try:
+            return bulk_write(Sensor, results, updates=updates)
+        finally:
+            for item in updates:
+                invalidate_sensor(item['sensor_id'])
+
     
     del_args ={
         'sensor_id': fields.Int(required=True)
@@ -462,14 +788,18 @@ class SensorResource(Resource):
         uid = get_jwt_identity()
         id = del_args['sensor_id']
 
-        sensor = Sensor.query.filter_by(sensor_id=id).first()
-        if not sensor:
+        access = sensor_access(id)
+        if not access:
             return {"msg": resp_msg['NO_ITEM']}, 404
-
-        device = Device.query.filter_by(device_id=sensor.device_id).first()
-        if device.uid != uid:
+        if access.uid != uid:
             return {"msg": resp_msg['NO_PERMISSION']}, 403
 
+        sensor = Sensor.query.filter_by(sensor_id=id).first()
+        if not sensor:
+            invalidate_sensor(id)
+            return {"msg": resp_msg['NO_ITEM']}, 404
+        rollups.forget_sensors([id])
+        dedup.forget_sensors([id])
         db.session.delete(sensor)
 
         try:
@@ -479,12 +809,84 @@ class SensorResource(Resource):
             return {
                 "msg": str(e.__dict__['orig'])
             }, 500
+        finally:
+            invalidate_sensor(id)
         
         return {
             "msg": resp_msg['DELETE'].format(sensor)
         }, 200
 
 
+class SensorStatsResource(Resource):
+    # Files and bytes uploaded per sensor and hour or day, read from the
+    # sensor_upload_stats rollup
+    get_args = {
+        'sensor_ids': fields.DelimitedList(fields.Int()),
+        'device_id': fields.Int(),
+        'start_date': fields.DateTime(format='%Y-%m-%dT%H:%M:%S'),
+        'end_date': fields.DateTime(format='%Y-%m-%dT%H:%M:%S'),
+        'interval': fields.Str(
+            missing='hour', validate=validate.OneOf(['hour', 'day', 'total']))
+    }
+
+    @use_args(get_args, location='query_or_json')
+    @jwt_required()
+    def get(self, get_args):
+        uid = get_jwt_identity()
+        stats = SensorUploadStats
+
+        columns = [stats.sensor_id]
+        if get_args['interval'] == 'hour':
+            columns.append(stats.bucket.label('bucket'))
+        elif get_args['interval'] == 'day':
+            columns.append(func.date(stats.bucket).label('bucket'))
+
+        statement = select(
+            *columns,
+            func.sum(stats.file_count).label('file_count'),
+            func.sum(stats.byte_count).label('byte_count')
+        ).join(Sensor, Sensor.sensor_id == stats.sensor_id)\
+            .join(Device, Device.device_id == Sensor.device_id)\
+            .filter(Device.uid == uid)
+
+        if 'sensor_ids' in get_args:
+            statement = statement.filter(
+                stats.sensor_id.in_(get_args['sensor_ids']))
+        if 'device_id' in get_args:
+            statement = statement.filter(
+                Sensor.device_id == get_args['device_id'])
+        # Buckets are whole hours: a bucket is counted when its hour starts
+        # within the range
+        if 'start_date' in get_args:
+            statement = statement.filter(
+                stats.bucket >= rollups.hour_bucket(get_args['start_date']))
+        if 'end_date' in get_args:
+            statement = statement.filter(stats.bucket < get_args['end_date'])
+
+        statement = statement.group_by(*columns).order_by(*columns)
+
+        try:
+            rows = db.session.execute(statement).all()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            return {
+                "msg": str(e.__dict__['orig'])
+            }, 500
+
+        if not rows:
+            return {"msg": resp_msg['NO_ITEM']}, 404
+
+        results = []
+        for row in rows:
+            item = row._asdict()
+            item['file_count'] = int(item['file_count'])
+            item['byte_count'] = int(item['byte_count'])
+            if 'bucket' in item and not isinstance(item['bucket'], str):
+                item['bucket'] = item['bucket'].isoformat()
+            results.append(item)
+        return results, 200
+
+
 class FileDetailResource(Resource):
     get_args = {
         'file_id': fields.Int(),
@@ -495,51 +897,80 @@ class FileDetailResource(Resource):
         'sensor_id': fields.Int(),
         'topic': fields.Str(),
         'start_date': fields.DateTime(format='%Y-%m-%dT%H:%M:%S'),
-        'end_date': fields.DateTime(format='%Y-%m-%dT%H:%M:%S')
+        'end_date': fields.DateTime(format='%Y-%m-%dT%H:%M:%S'),
+        'limit': fields.Int(validate=validate.Range(min=1)),
+        'cursor': fields.Str(),
+        'match': match_arg
     }
 
-    @use_args(get_args, location='json')
+    @use_args(get_args, location='query_or_json')
     @jwt_required()
     def get(self, get_args):
+        limit = min(
+            get_args.get('limit', app.config['FILEDETAIL_PAGE_SIZE']),
+            app.config['FILEDETAIL_MAX_PAGE_SIZE'])
+
         statement = select(
             File.file_id,
             File.file_name,
             File.path,
             Sensor.sensor_id,
             Sensor.sensor_name,
-            SensorFile.upload_date
-        ).select_from(File).join(SensorFile).join(Sensor)\
-            .filter(File.path.startswith('files/')).filter(File.mimetype > 2)
-        
-        if 'tag_id' in get_args or 'tag_name' in get_args:
-            statement = statement.join(File.tags)
-            if 'tag_id' in get_args:
-                statement = statement.filter(Tag.tag_id == get_args['tag_id'])
-            if 'tag_name' in get_args:
-                statement = statement.filter(
-                    Tag.tag_name.contains(get_args['tag_name']))
-        if 'file_id' in get_args:
-            statement = statement.filter(File.file_id == get_args['file_id'])
-        if 'sensor_id' in get_args:
-            statement = statement.filter(
-                Sensor.sensor_id == get_args['sensor_id'])
-        if 'start_date' in get_args:
-            statement = statement.filter(
-                SensorFile.upload_date > get_args['start_date'])
-        if 'end_date' in get_args:
-            statement = statement.filter(
-                SensorFile.upload_date < get_args['end_date'])
-        
-        statement = statement.order_by(SensorFile.upload_date.desc())
-        rows = db.session.execute(statement).all()
-
-        if not rows:
+            SensorFile.upload_date,
+            file_tags().label('tags')
+        ).select_from(File).join(SensorFile).join(Sensor)
+        statement = filter_files(statement, get_args)
+
+        # Keyset pagination: continue strictly after the last row of the
+        # previous page, so deep pages cost the same as the first one
+        if 'cursor' in get_args:
+            position = decode_cursor(get_args['cursor'])
+            if not position:
+                return {"msg": "Invalid cursor"}, 400
+            upload_date, file_id = position
+            statement = statement.filter(or_(
+                SensorFile.upload_date < upload_date,
+                and_(SensorFile.upload_date == upload_date,
+                     SensorFile.file_id < file_id)
+            ))
+
+        statement = statement.order_by(
+            SensorFile.upload_date.desc(), SensorFile.file_id.desc())
+
+        # Rows are only ever added with a later upload_date, moved to
+        # another sensor or (un)tagged, which the count, maxima and sums
+        # pick up
+        etag = make_etag('filedetail', get_args, limit, fingerprint(
+            statement.limit(limit),
+            max_of=[SensorFile.upload_date, SensorFile.file_id],
+            sum_of=[SensorFile.sensor_id, file_tag_count()]))
+        response = not_modified(etag)
+        if response:
+            return response
+
+        # Headers go out before the streamed body, so look up where the next
+        # page starts first. This reads two keys off the index at the end of
+        # the page rather than the page itself.
+        keys = db.session.execute(
+            statement.with_only_columns(
+                SensorFile.upload_date, SensorFile.file_id
+            ).offset(limit - 1).limit(2)
+        ).all()
+        headers = etag_headers(etag)
+        if len(keys) > 1:
+            headers['X-Next-Cursor'] = encode_cursor(*keys[0])
+
+        def to_dict(row):
+            item = row._asdict()
+            item['tags'] = parse_file_tags(item['tags'])
+            return item
+
+        first, rows = peek(stream_rows(statement.limit(limit)))
+
+        if first is None:
             return {"msg": resp_msg['NO_ITEM']}, 404
-        
-        return Response(
-            dumps([row._asdict() for row in rows], default=json_serial),
-            mimetype='application/json'
-        )
+
+        return json_list_response(rows, to_dict, headers=headers)
 
 
     put_args = {
@@ -567,13 +998,15 @@ class FileDetailResource(Resource):
             sensor_id = put_args['sensor_id']
             if not get_sensor_permission(sensor_id):
                 return {"msg": resp_msg['NO_PERMISSION']}, 403
+            rollups.move_upload(sensorfile, file.size, sensor_id)
+            dedup.move_file(file_id, sensor_id)
             sensorfile.sensor_id = sensor_id
         if 'tag_id' in put_args:
             tag = Tag.query.filter_by(tag_id=put_args['tag_id']).first()
             if not tag:
                 return {"msg": "No tag of that ID"}, 404
-            file.tags.append(tag)
-            db.session.add(file)
+            if not file_has_tag(file_id, tag.tag_id):
+                add_file_tag(file_id, tag.tag_id)
 
         try:
             db.session.commit()
@@ -609,9 +1042,8 @@ class FileDetailResource(Resource):
             return {"msg": resp_msg['NO_PERMISSION']}, 403
 
         tag = Tag.query.filter_by(tag_id=del_args['tag_id']).first()
-        if tag not in file.tags:
+        if not tag or not remove_file_tag(file_id, tag.tag_id):
             return {"msg": "File not tagged with that ID"}, 404
-        file.tags.remove(tag)
         
         try:
             db.session.commit()
@@ -626,35 +1058,127 @@ class FileDetailResource(Resource):
         }, 200
 
 
+class FileTagResource(Resource):
+    # Files are picked by file_ids and/or the filters of /api/filedetail;
+    # has_tag_id selects files that already carry that tag
+    args = {
+        'tag_id': fields.Int(required=True),
+        'file_ids': fields.List(fields.Int()),
+        'has_tag_id': fields.Int(),
+        'tag_name': fields.Str(),
+        'datatype_id': fields.Int(),
+        'device_id': fields.Int(),
+        'sensor_id': fields.Int(),
+        'topic': fields.Str(),
+        'start_date': fields.DateTime(format='%Y-%m-%dT%H:%M:%S'),
+        'end_date': fields.DateTime(format='%Y-%m-%dT%H:%M:%S')
+    }
+
+    def select_files(self, args):
+        """Statement selecting the ids of the caller's files that match
+        args, or None if args select no files at all"""
+
+        filters = dict(args)
+        tag_id = filters.pop('tag_id')
+        if 'has_tag_id' in filters:
+            filters['tag_id'] = filters.pop('has_tag_id')
+        if not filters:
+            return None, tag_id
+
+        statement = select(File.file_id).select_from(File)\
+            .join(SensorFile).join(Sensor).join(Device)\
+            .filter(Device.uid == get_jwt_identity())
+        return filter_files(statement, filters).distinct(), tag_id
+
+    @use_args(args, location='json')
+    @jwt_required()
+    def put(self, args):
+        statement, tag_id = self.select_files(args)
+        if statement is None:
+            return {"msg": "Give file_ids or at least one filter"}, 400
+        if not Tag.query.filter_by(tag_id=tag_id).first():
+            return {"msg": "No tag of that ID"}, 404
+
+        # One INSERT ... SELECT over the caller's matching files that
+        # don't carry the tag yet. has_tag_id joins tag_map into the outer
+        # query, so the subquery reads an alias of its own and correlates
+        # on File only.
+        tagged = tag_map.alias('tagged')
+        already_tagged = select(tagged.c.objectid).where(and_(
+            tagged.c.objectid == File.file_id,
+            tagged.c.objecttype == 'files',
+            tagged.c.systemtagid == tag_id
+        )).correlate(File).exists()
+        statement = statement.with_only_columns(
+            File.file_id, literal('files'), literal(tag_id)
+        ).filter(~already_tagged)
+
+        try:
+            result = db.session.execute(insert(tag_map).from_select(
+                ['objectid', 'objecttype', 'systemtagid'], statement))
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            return {
+                "msg": str(e.__dict__['orig'])
+            }, 500
+
+        return {
+            "msg": "Tag {} added to {} files".format(tag_id, result.rowcount),
+            "files_changed": result.rowcount
+        }, 200
+
+    @use_args(args, location='json')
+    @jwt_required()
+    def delete(self, args):
+        statement, tag_id = self.select_files(args)
+        if statement is None:
+            return {"msg": "Give file_ids or at least one filter"}, 400
+
+        # MySQL can't DELETE from a table that the WHERE subquery also reads
+        # (has_tag_id joins the mapping table), so pick the ids first
+        file_ids = db.session.execute(statement).scalars().all()
+
+        changed = 0
+        batch_size = app.config['DELETE_BATCH_SIZE']
+        try:
+            for start in range(0, len(file_ids), batch_size):
+                result = db.session.execute(delete(tag_map).where(
+                    tag_map.c.objectid.in_(file_ids[start:start + batch_size]),
+                    tag_map.c.objecttype == 'files',
+                    tag_map.c.systemtagid == tag_id))
+                changed += result.rowcount
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            return {
+                "msg": str(e.__dict__['orig'])
+            }, 500
+
+        return {
+            "msg": "Tag {} removed from {} files".format(tag_id, changed),
+            "files_changed": changed
+        }, 200
+
+
 class TagResource(Resource):
     get_args = {
         'tag_id': fields.Int(),
-        'tag_name': fields.Str()
+        'tag_name': fields.Str(),
+        'match': match_arg
     }
 
-    @use_args(get_args, location='json')
+    @use_args(get_args, location='query_or_json')
     @jwt_required()
     def get(self, get_args):
-        statement = select(
-            Tag.tag_id,
-            Tag.tag_name
-        )
-
-        if 'tag_id' in get_args:
-            statement = statement.filter(
-                Tag.tag_id == get_args['tag_id']
-            )
-        if 'tag_name' in get_args:
-            statement = statement.filter(
-                Tag.tag_name.contains(get_args['tag_name'])
-            )
-        
-        rows = db.session.execute(statement).all()
+        match = get_args.pop('match')
+        rows = refdata.filter_rows(refdata.tags.rows(), get_args, match)
 
         if not rows:
             return {"msg": resp_msg['NO_ITEM']}, 404
 
-        return [row._asdict() for row in rows]
+        etag = make_etag('tag', rows)
+        return not_modified(etag) or (rows, 200, etag_headers(etag))
 
     post_args = {
         'tag_name': fields.Str(required=True)
@@ -673,12 +1197,42 @@ class TagResource(Resource):
             return {
                 "msg": str(e.__dict__['orig'])
             }, 500
+        refdata.tags.invalidate()
         
         return {
             "msg": resp_msg['INSERT'].format(tag)
         }, 200
     
 
+class SearchResource(Resource):
+    get_args = {
+        'q': fields.Str(required=True, validate=validate.Length(min=1)),
+        'kind': fields.DelimitedList(
+            fields.Str(validate=validate.OneOf(search.KIND_NAMES))),
+        'limit': fields.Int(validate=validate.Range(min=1))
+    }
+
+    @use_args(get_args, location='query_or_json')
+    @jwt_required()
+    def get(self, get_args):
+        limit = min(
+            get_args.get('limit', app.config['SEARCH_MAX_RESULTS']),
+            app.config['SEARCH_MAX_RESULTS'])
+        try:
+            results = search.search(
+                get_args['q'],
+                get_jwt_identity(),
+                kinds=get_args.get('kind'),
+                limit=limit)
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            return {
+                "msg": str(e.__dict__['orig'])
+            }, 500
+
+        return results, 200
+
+
 class FileManageResource(Resource):
     put_args = {
         'sensor_id': fields.Int(required=True),
@@ -686,13 +1240,16 @@ class FileManageResource(Resource):
         'tag_id': fields.Int(),
         'extension': fields.Str(required=True),
         'user': fields.Str(required=True),
-        'password': fields.Str(required=True)
+        'password': fields.Str(required=True),
+        'async': fields.Bool(missing=False),
+        # Optional hex SHA-256 of the (decoded) body, checked against what
+        # arrives
+        'sha256': fields.Str(validate=validate.Regexp(r'^[0-9a-fA-F]{64}$'))
     }
 
     @use_args(put_args, location='headers')
     @jwt_required()
     def put(self, put_args):
-        print("API receive time {}".format(round(time.time() * 1000)))
         uid = get_jwt_identity()
         user = put_args['user']
         password = put_args['password']
@@ -704,51 +1261,409 @@ class FileManageResource(Resource):
         if request.content_length == 0:
             return {"msg": "No file content"}
 
-        if not Sensor.query.filter_by(sensor_id=sensor_id).first():
+        max_length = app.config['MAX_CONTENT_LENGTH']
+        if max_length is not None and request.content_length is not None\
+                and request.content_length > max_length:
+            abort(413)
+
+        access = sensor_access(sensor_id)
+        if not access:
             return {"msg": resp_msg['NO_ITEM']}, 404
 
-        if uid != user or not get_sensor_permission(sensor_id):
+        if uid != user or access.uid != uid:
             return {"msg": resp_msg['NO_PERMISSION']}, 403
+
+        if app.config['REJECT_DISABLED_SENSORS'] and not access.is_enabled:
+            return {"msg": "Sensor is disabled"}, 403
         
         if extension not in app.config['ALLOWED_EXTENSIONS']:
             return {"msg": "This extension is not allowed"}, 400
 
+        # Compressed bodies are inflated a chunk at a time as they are
+        # read; MAX_DECOMPRESSED_LENGTH then caps what they expand to
+        encoding = (request.content_encoding or 'identity').strip().lower()
+        if encoding not in supported_encodings():
+            return {"msg": "Unsupported Content-Encoding {}".format(
+                encoding)}, 415
+        stream = request.stream
+        length = request.content_length
+        if encoding != 'identity':
+            stream = DecodingStream(
+                stream, encoding, app.config['UPLOAD_CHUNK_SIZE'])
+            length = None
+            max_length = app.config['MAX_DECOMPRESSED_LENGTH']
+
+        compress = store_compressed(access.datatype_id)
         path = append_slash(path) + file_namer(sensor_id, extension)
+        if compress:
+            path += '.gz'
         endpoint = "{}{}{}".format(
             app.config['NEXTCLOUD_WEBDAV'],
             append_slash(uid),
             path)
 
-        auth = HTTPBasicAuth(user, password)
-        response = requests.put(
-            endpoint,
-            auth=auth,
-            data=request.data,
-        )
-        response.raise_for_status()
-
-        etag = response.headers.get('ETag').strip('"')
-        file = File.query.filter_by(etag=etag).first()
-        db.session.add(SensorFile(file_id=file.file_id, sensor_id=sensor_id))
-        
+        tag = None
         if 'tag_id' in put_args:
             tag = Tag.query.filter_by(tag_id=put_args['tag_id']).first()
             if not tag:
                 return {"msg": "No tag of that ID"}, 404
-            file.tags.append(tag)
-            db.session.add(file)
+
+        # In async mode the body goes to the local spool and a background
+        # worker pushes it to Nextcloud, so the client isn't held waiting
+        if put_args['async']:
+            # Don't hold a database connection while the body comes in
+            db.session.close()
+            job = spool.create_job(
+                stream,
+                uid=uid,
+                user=user,
+                password=password,
+                sensor_id=sensor_id,
+                endpoint=endpoint,
+                path=path,
+                tag_id=put_args.get('tag_id'),
+                length=length,
+                max_length=max_length,
+                compress=compress,
+                sha256=put_args.get('sha256')
+            )
+            if job.get('duplicate'):
+                return {
+                    "msg": "File already uploaded",
+                    "file_id": job['file_id'],
+                    "duplicate": True,
+                    "job": job
+                }, 200
+            return {
+                "msg": "File accepted for upload",
+                "job": job
+            }, 202
+
+        # Give the database connection back to the pool for the length of
+        # the transfer; under green-thread workers hundreds of uploads can
+        # be in flight against a handful of connections
+        db.session.close()
+
+        # Stream the body straight through to WebDAV so memory use stays
+        # flat no matter how large the file is
+        body = UploadStream(
+            stream,
+            length=length,
+            max_length=max_length,
+            chunk_size=app.config['UPLOAD_CHUNK_SIZE'])
+
+        sha256 = None
+        if dedup.enabled() and app.config['DEDUP_BEFORE_UPLOAD']:
+            # Take in the whole body first so that a repeat is caught before
+            # anything is sent to Nextcloud
+            body, sha256 = buffer_body(body, app.config['DEDUP_MEMORY_LIMIT'])
+            check_sha256(put_args.get('sha256'), sha256)
+            existing = dedup.find_duplicate(sensor_id, sha256)
+            if existing:
+                return self.duplicate(existing, tag)
+            db.session.close()
+
+        sent = gzipped(body) if compress else body
+        response = push_to_nextcloud(
+            endpoint, user, password, with_length(sent), source=body)
+        # Hashed on the way through
+        sha256 = sha256 or body.sha256.hexdigest()
+
+        try:
+            check_sha256(put_args.get('sha256'), sha256)
+        except BadRequest:
+            remove_from_nextcloud(endpoint, user, password)
+            raise
+
+        file = find_uploaded_file(response, uid, path)
+        if not file:
+            return {"msg": "Uploaded file not found in the filecache"}, 500
+        file_id = file.file_id
+
+        # A repeat of a file the sensor already has: drop the new copy and
+        # answer with the earlier one. If Nextcloud won't delete it, keep
+        # it as an upload of its own.
+        existing = dedup.find_duplicate(sensor_id, sha256)
+        if existing and existing != file_id \
+                and remove_from_nextcloud(endpoint, user, password):
+            return self.duplicate(existing, tag)
+
+        record_sensor_file(file, sensor_id, tag, sha256)
         
         try:
-            db.session.commit()
+            with phase('commit'):
+                db.session.commit()
         except SQLAlchemyError as e:
             db.session.rollback()
             return {
                 "msg": str(e.__dict__['orig'])
             }, 500
 
-        print("API respond time {}".format(round(time.time() * 1000)))
         return {
-            "msg": "File uploaded successfully"
+            "msg": "File uploaded successfully",
+            "file_id": file_id
         }, response.status_code
 
+    def duplicate(self, file_id, tag=None):
+        # The sensor already has this file: point the client at it
+        # instead of storing a second copy
+        link_duplicate(file_id, tag)
+        try:
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            return {
+                "msg": str(e.__dict__['orig'])
+            }, 500
+
+        return {
+            "msg": "File already uploaded",
+            "file_id": file_id,
+            "duplicate": True
+        }, 200
+
+
+class UploadJobResource(Resource):
+    get_args = {
+        'job_id': fields.Str(required=True)
+    }
+
+    @use_args(get_args, location='query_or_json')
+    @jwt_required()
+    def get(self, get_args):
+        job = spool.get_job(get_args['job_id'])
+        if not job:
+            return {"msg": resp_msg['NO_ITEM']}, 404
+        if job['uid'] != get_jwt_identity():
+            return {"msg": resp_msg['NO_PERMISSION']}, 403
+        return job
+
+
+class FileDownloadResource(Resource):
+    get_args = {
+        'user': fields.Str(required=True),
+        'password': fields.Str(required=True)
+    }
+
+    @use_args(get_args, location='headers')
+    @jwt_required()
+    def get(self, get_args, file_id):
+        uid = get_jwt_identity()
+        if get_args['user'] != uid:
+            return {"msg": resp_msg['NO_PERMISSION']}, 403
+
+        row = db.session.execute(
+            select(SensorFile.sensor_id, File.path, File.file_name,
+                   File.etag, File.size)
+            .join(File, File.file_id == SensorFile.file_id)
+            .filter(SensorFile.file_id == file_id)
+        ).first()
+        if not row:
+            return {"msg": resp_msg['NO_ITEM']}, 404
+        if not get_sensor_permission(row.sensor_id):
+            return {"msg": resp_msg['NO_PERMISSION']}, 403
+        # Nothing below needs the database
+        db.session.close()
+
+        etag = row.etag
+        mimetype = downloads.guess_mimetype(row.file_name)
+        if etag:
+            response = not_modified(etag)
+            if response:
+                return response
+
+        # A copy cached under the current oc_filecache etag is the same
+        # file Nextcloud would send; send_file also answers Range requests
+        cached = downloads.cached_copy(file_id, etag)
+        if cached:
+            try:
+                response = send_file(
+                    cached,
+                    mimetype=mimetype,
+                    download_name=row.file_name,
+                    conditional=True,
+                    etag=etag or False)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            except FileNotFoundError:
+                # Evicted by another worker in the meantime
+                pass
+
+        try:
+            upstream = downloads.open_download(
+                uid, row.path, get_args['user'], get_args['password'],
+                byte_range=request.headers.get('Range'))
+        except requests.RequestException as e:
+            return {"msg": str(e)}, 502
+
+        if upstream.status_code not in (200, 206):
+            upstream.close()
+            if upstream.status_code == 404:
+                return {"msg": resp_msg['NO_ITEM']}, 404
+            if upstream.status_code in (401, 403):
+                return {"msg": "Nextcloud refused these credentials"}, 401
+            if upstream.status_code == 416:
+                return {"msg": "Requested range not satisfiable"}, 416
+            return {"msg": "Nextcloud answered {}".format(
+                upstream.status_code)}, 502
+
+        headers = {name: upstream.headers[name]
+                   for name in downloads.PROXIED_HEADERS
+                   if name in upstream.headers}
+        headers['Accept-Ranges'] = 'bytes'
+        headers['X-Cache'] = 'MISS'
+        if etag:
+            headers.update(etag_headers(etag))
+        return Response(
+            downloads.stream_download(upstream, file_id, etag, row.size),
+            status=upstream.status_code,
+            mimetype=mimetype,
+            headers=headers,
+            direct_passthrough=True)
+
+
+class FileBatchResource(Resource):
+    post_args = {
+        'sensor_id': fields.Int(required=True),
+        'path': fields.Str(required=True),
+        'tag_id': fields.Int(),
+        'user': fields.Str(required=True),
+        'password': fields.Str(required=True)
+    }
+
+    @use_args(post_args, location='headers')
+    @jwt_required()
+    def post(self, post_args):
+        uid = get_jwt_identity()
+        user = post_args['user']
+        password = post_args['password']
+        sensor_id = post_args['sensor_id']
+
+        # Authorize once for the whole batch
+        access = sensor_access(sensor_id)
+        if not access:
+            return {"msg": resp_msg['NO_ITEM']}, 404
+
+        if uid != user or access.uid != uid:
+            return {"msg": resp_msg['NO_PERMISSION']}, 403
+
+        if app.config['REJECT_DISABLED_SENSORS'] and not access.is_enabled:
+            return {"msg": "Sensor is disabled"}, 403
+
+        uploads = request.files.getlist('file')
+        if not uploads:
+            return {"msg": "No file content"}, 400
+        if len(uploads) > app.config['BATCH_MAX_FILES']:
+            return {"msg": "Too many files in one batch (>{})".format(
+                app.config['BATCH_MAX_FILES'])}, 400
+
+        tag = None
+        if 'tag_id' in post_args:
+            tag = Tag.query.filter_by(tag_id=post_args['tag_id']).first()
+            if not tag:
+                return {"msg": "No tag of that ID"}, 404
+
+        # Stored the way PUT /api/file stores this datatype
+        compress = store_compressed(access.datatype_id)
+
+        results = []
+        pending = []
+        recorded = []
+        # Parts whose content came earlier in the same batch, with the
+        # result of that earlier part
+        repeats = []
+        first_of = {}
+        chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+        for upload in uploads:
+            result = {"filename": upload.filename}
+            results.append(result)
+
+            extension = upload.filename.rsplit('.', 1)[-1].lower()\
+                if '.' in (upload.filename or '') else ''
+            if extension not in app.config['ALLOWED_EXTENSIONS']:
+                result.update(status=400, msg="This extension is not allowed")
+                continue
+
+            # The parts are already in, so repeats are caught before
+            # anything is sent to Nextcloud
+            sha256 = None
+            if dedup.enabled():
+                sha256 = sha256_of(upload.stream, chunk_size)
+                existing = dedup.find_duplicate(sensor_id, sha256)
+                if existing:
+                    result.update(status=200, file_id=existing,
+                                  duplicate=True, msg="File already uploaded")
+                    recorded.append(result)
+                    continue
+                if sha256 in first_of:
+                    repeats.append((result, first_of[sha256]))
+                    continue
+                first_of[sha256] = result
+
+            path = append_slash(post_args['path'])\
+                + file_namer(sensor_id, extension)
+            stream = upload.stream
+            if compress:
+                path += '.gz'
+                stream = with_length(gzipped(stream))
+            endpoint = "{}{}{}".format(
+                app.config['NEXTCLOUD_WEBDAV'],
+                append_slash(uid),
+                path)
+            result['path'] = path
+            pending.append((result, endpoint, stream, sha256))
+
+        def push(item):
+            result, endpoint, stream, _ = item
+            try:
+                return put_to_nextcloud(endpoint, user, password, stream)
+            except requests.RequestException as e:
+                return e
+
+        db.session.close()
+        # The pool's threads have no request to record phases against, so
+        # the transfers are timed here, as one phase
+        with phase('webdav'), ThreadPoolExecutor(
+                max_workers=app.config['BATCH_UPLOAD_CONCURRENCY']) as pool:
+            responses = list(pool.map(push, pending))
+
+        # Record every file that reached Nextcloud, and tag the ones the
+        # sensor already had, in one transaction
+        for result in recorded:
+            link_duplicate(result['file_id'], tag)
+        for (result, _, _, sha256), response in zip(pending, responses):
+            if isinstance(response, Exception):
+                status = getattr(response.response, 'status_code', None)
+                result.update(status=status or 502, msg=str(response))
+                continue
+            file = find_uploaded_file(response, uid, result['path'])
+            if not file:
+                result.update(status=500,
+                              msg="Uploaded file not found in the filecache")
+                continue
+            result.update(status=response.status_code, file_id=file.file_id)
+            record_sensor_file(file, sensor_id, tag, sha256)
+            recorded.append(result)
+
+        try:
+            with phase('commit'):
+                db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            for result in recorded:
+                result.update(status=500, msg=str(e.__dict__['orig']))
+                result.pop('file_id')
+                result.pop('duplicate', None)
+
+        for result in recorded:
+            if 'msg' not in result:
+                result['msg'] = "File uploaded successfully"
+
+        for result, first in repeats:
+            if 'file_id' in first:
+                result.update(status=200, file_id=first['file_id'],
+                              duplicate=True, msg="File already uploaded")
+            else:
+                result.update(status=first['status'], msg=first['msg'])
 
+        return {"results": results}, 200
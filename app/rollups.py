@@ -0,0 +1,122 @@
+import click
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import app, db
+from app.models import File, Sensor, SensorFile, SensorUploadStats
+
+stats = SensorUploadStats.__table__
+
+
+def hour_bucket(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def add_uploads(sensor_id, uploaded_at, file_count=1, byte_count=0):
+    """Add files to the hourly rollup of a sensor. Negative counts take
+    them off again.
+
+    Runs as a single upsert in the caller's transaction, so the rollup
+    commits or rolls back together with the sensor_files rows it counts.
+    """
+    values = dict(
+        sensor_id=sensor_id,
+        bucket=hour_bucket(uploaded_at),
+        file_count=file_count,
+        byte_count=byte_count or 0
+    )
+    dialect = db.engine.dialect.name
+
+    if dialect == 'mysql':
+        statement = mysql_insert(stats).values(**values)
+        statement = statement.on_duplicate_key_update(
+            file_count=stats.c.file_count + statement.inserted.file_count,
+            byte_count=stats.c.byte_count + statement.inserted.byte_count)
+    else:
+        dialect_insert = {
+            'sqlite': sqlite_insert,
+            'postgresql': postgresql_insert
+        }[dialect]
+        statement = dialect_insert(stats).values(**values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[stats.c.sensor_id, stats.c.bucket],
+            set_=dict(
+                file_count=stats.c.file_count + statement.excluded.file_count,
+                byte_count=stats.c.byte_count + statement.excluded.byte_count))
+    db.session.execute(statement)
+
+
+def move_upload(sensorfile, size, sensor_id):
+    """Count a file under sensor_id instead of its current sensor"""
+
+    if sensorfile.upload_date is None or sensorfile.sensor_id == sensor_id:
+        return
+    add_uploads(sensorfile.sensor_id, sensorfile.upload_date, -1, -(size or 0))
+    add_uploads(sensor_id, sensorfile.upload_date, 1, size)
+
+
+def forget_sensors(sensor_ids):
+    """Drop the rollups of sensors about to be deleted"""
+
+    db.session.execute(
+        delete(SensorUploadStats)
+        .where(SensorUploadStats.sensor_id.in_(sensor_ids))
+        .execution_options(synchronize_session=False))
+
+
+def upload_hour():
+    """sensor_files.upload_date truncated to the hour, in SQL"""
+
+    dialect = db.engine.dialect.name
+    if dialect == 'mysql':
+        return func.date_format(SensorFile.upload_date, '%Y-%m-%d %H:00:00')
+    if dialect == 'sqlite':
+        # Match the text SQLAlchemy stores for a DateTime on SQLite
+        return func.strftime(
+            '%Y-%m-%d %H:00:00.000000', SensorFile.upload_date)
+    return func.date_trunc('hour', SensorFile.upload_date)
+
+
+def rebuild(sensor_id):
+    """Recount the rollup of one sensor from sensor_files"""
+
+    bucket = upload_hour()
+    forget_sensors([sensor_id])
+    db.session.execute(insert(stats).from_select(
+        ['sensor_id', 'bucket', 'file_count', 'byte_count'],
+        select(
+            SensorFile.sensor_id,
+            bucket,
+            func.count(),
+            func.coalesce(func.sum(File.size), 0)
+        )
+        .join(File, File.file_id == SensorFile.file_id)
+        .filter(SensorFile.sensor_id == sensor_id)
+        .filter(SensorFile.upload_date.isnot(None))
+        .group_by(SensorFile.sensor_id, bucket)
+    ))
+
+
+def rebuild_all(sensor_ids=None):
+    """Recount the rollups of the given sensors, or of every sensor,
+    returning how many were rebuilt"""
+
+    sensor_ids = sensor_ids or db.session.execute(
+        select(Sensor.sensor_id).order_by(Sensor.sensor_id)).scalars().all()
+    # One transaction per sensor keeps locks on sensor_files short
+    for sensor_id in sensor_ids:
+        rebuild(sensor_id)
+        db.session.commit()
+    return len(sensor_ids)
+
+
+@app.cli.command('backfill-upload-stats')
+@click.option('--sensor-id', type=int, multiple=True,
+              help='Only rebuild these sensors.')
+def backfill_upload_stats(sensor_id):
+    """Rebuild sensor_upload_stats from sensor_files."""
+
+    count = rebuild_all(sensor_id)
+    click.echo('Rebuilt upload stats of {} sensors'.format(count))
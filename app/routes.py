@@ -1,32 +1,61 @@
+import hashlib
+import hmac
 import os
 import time
 import xml.etree.ElementTree as ET
 from datetime import timedelta
 
-import requests
 from flask import abort, jsonify
 from flask_httpauth import HTTPBasicAuth
 # Flask JSON Web Token manager
 from flask_jwt_extended import (create_access_token, create_refresh_token,
-                                get_jwt_identity, jwt_required)
+                                get_jwt_identity)
 from flask_restful import Api
 from requests.auth import HTTPBasicAuth as RequestsAuth
 
-from app import app
+from app import app, metrics, nextcloud, spool, sqlprofile
+from app.cache import TTLCache
+from app.metrics import jwt_required, phase
 from app.resources import (DatatypeResource, DeviceResource,
-                           FileDetailResource, FileManageResource,
-                           SensorResource, TagResource)
+                           FileBatchResource, FileDetailResource,
+                           FileDownloadResource,
+                           FileManageResource, FileTagResource,
+                           SearchResource, SensorResource,
+                           SensorStatsResource, TagResource,
+                           UploadJobResource)
 
 auth = HTTPBasicAuth()
 api = Api(app)
 app.secret_key = os.urandom(24)
 
+# Recent Nextcloud verifications, keyed by a salted hash of the credentials
+# so that no password is ever held in memory in the clear
+credential_cache = TTLCache(
+    maxsize=app.config['CREDENTIAL_CACHE_SIZE'],
+    ttl=app.config['CREDENTIAL_CACHE_TTL']
+)
+credential_salt = os.urandom(16)
+
 api.add_resource(DatatypeResource, '/api/datatype')
 api.add_resource(DeviceResource, '/api/device')
 api.add_resource(SensorResource, '/api/sensor')
+api.add_resource(SensorStatsResource, '/api/sensor/stats')
 api.add_resource(FileDetailResource, '/api/filedetail')
+api.add_resource(FileTagResource, '/api/filedetail/tags')
 api.add_resource(TagResource, '/api/tag')
+api.add_resource(SearchResource, '/api/search')
 api.add_resource(FileManageResource, '/api/file')
+api.add_resource(UploadJobResource, '/api/file/job')
+api.add_resource(FileBatchResource, '/api/file/batch')
+api.add_resource(FileDownloadResource, '/api/file/<int:file_id>')
+
+
+@app.before_first_request
+def recover_upload_spool():
+    # Replay uploads that were accepted but not yet pushed to Nextcloud
+    # when the previous process stopped. gunicorn.conf.py already does so
+    # as each worker starts; this covers `flask run`.
+    spool.recover()
 
 
 @app.route('/', methods=['GET'])
@@ -36,6 +65,29 @@ def index():
     return jsonify(logged_in_as=current_user)
 
 
+@app.route('/api/nextcloud/pool', methods=['GET'])
+@jwt_required()
+def nextcloud_pool():
+    return jsonify(pools=nextcloud.pool_stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    return metrics.prometheus_text(), 200, {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+    }
+
+
+@app.route('/api/sqlprofile', methods=['GET'])
+@jwt_required()
+def sql_profile():
+    if not app.config['SQL_PROFILE']:
+        abort(404)
+    return jsonify(endpoints=sqlprofile.report())
+
+
 @app.route('/login', methods=['POST'])
 @auth.login_required
 def login():
@@ -69,15 +121,42 @@ def verify_password(username, password):
     if not (username and password):
         abort(401)
 
+    key = hmac.new(
+        credential_salt,
+        '{}\0{}'.format(username, password).encode('utf-8'),
+        hashlib.sha256
+    ).digest()
+    verified = credential_cache.get(key)
+    if verified is None:
+        verified = check_nextcloud_user(username, password)
+        # None means Nextcloud itself failed, which says nothing about
+        # the credentials and so is never cached
+        if verified is not None:
+            credential_cache.set(
+                key,
+                verified,
+                ttl=None if verified\
+                    else app.config['CREDENTIAL_CACHE_NEGATIVE_TTL']
+            )
+
+    if verified:
+        return username
+    abort(401)
+
+
+def check_nextcloud_user(username, password):
     # Authenticate against Nextcloud and fetch user data
     endpoint = app.config['NEXTCLOUD_USER_ENDPOINT'] + username
-    response = requests.get(
-        endpoint,
-        headers={'OCS-APIRequest': 'true'},
-        auth=RequestsAuth(username, password)
-    )
+    with phase('ocs'):
+        response = nextcloud.get(
+            endpoint,
+            headers={'OCS-APIRequest': 'true'},
+            auth=RequestsAuth(username, password)
+        )
+    if response.status_code >= 500:
+        return None
     if response.status_code != 200:
-        abort(401)
+        return False
 
     # Read XML response from Nextcloud.
     # tree_root[0][0] finds the tag <status>
@@ -85,12 +164,9 @@ def verify_password(username, password):
     # tree_root[1][2] finds <id>, the user ID recorded on the Nextcloud system
     # See more at https://docs.nextcloud.com/server/14/developer_manual/client_apis/OCS/index.html
     tree_root = ET.fromstring(response.content)
-    if (tree_root[0][0].text == 'ok'
-        and tree_root[1][0].text == '1'
-        and tree_root[1][2].text == username):
-        return username
-    else:
-        abort(401)
+    return (tree_root[0][0].text == 'ok'
+            and tree_root[1][0].text == '1'
+            and tree_root[1][2].text == username)
 
 
 @app.errorhandler(422)
@@ -0,0 +1,131 @@
+import os
+import pickle
+import time
+
+import click
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import app, db
+
+# Nextcloud and sensor tables mapped in app/models.py. Only these are
+# reflected; the rest of the Nextcloud schema is never loaded.
+MODEL_TABLES = [
+    'oc_users',
+    'oc_storages',
+    'oc_filecache',
+    'oc_systemtag',
+    'oc_systemtag_object_mapping',
+    'datatypes',
+    'devices',
+    'sensors',
+    'sensor_files'
+]
+
+# Tables that belong to this app rather than Nextcloud, declared in full in
+# app/models.py and created at startup when missing
+APP_TABLES = [
+    'sensor_upload_stats',
+    'sensor_file_hashes'
+]
+
+# Indexes on the sensor tables that queries of this app rely on, as (name,
+# table, columns). `flask create-indexes` adds them; they aren't built at
+# startup, since that can take a while on a large table.
+INDEXES = [
+    # /api/filedetail pages, read in (upload_date, fileid) order
+    ('ix_sensor_files_date', 'sensor_files', ('upload_date', 'fileid'))
+]
+
+# Seconds spent loading the schema at startup
+load_seconds = None
+
+
+def load():
+    """Load the table metadata the models extend, timing how long it takes.
+
+    With SCHEMA_CACHE_FILE set, metadata reflected once is pickled there and
+    read back on later boots instead of querying the database. With
+    SCHEMA_REFLECT off, the columns declared in app/models.py are used as is.
+    """
+    global load_seconds
+
+    start = time.perf_counter()
+    metadata = db.Model.metadata
+    cache_file = app.config.get('SCHEMA_CACHE_FILE')
+    source = 'declared'
+
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            for table in pickle.load(f).tables.values():
+                table.to_metadata(metadata)
+        source = 'cache'
+    elif app.config.get('SCHEMA_REFLECT', True):
+        metadata.reflect(bind=db.engine, only=MODEL_TABLES)
+        source = 'database'
+        if cache_file:
+            tmp = cache_file + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(metadata, f)
+            os.replace(tmp, cache_file)
+
+    # Don't hand connections opened here to workers forked by --preload
+    db.engine.dispose()
+
+    load_seconds = time.perf_counter() - start
+    print("Schema loaded from {} in {:.3f}s ({} tables)".format(
+        source, load_seconds, len(metadata.tables)))
+
+
+def create_app_tables():
+    """Create the APP_TABLES that don't exist yet. Runs once the models are
+    imported, so that their columns are declared."""
+
+    metadata = db.Model.metadata
+    existing = set(inspect(db.engine).get_table_names())
+    created = []
+    for name in APP_TABLES:
+        if name in existing:
+            continue
+        try:
+            metadata.tables[name].create(bind=db.engine)
+        except SQLAlchemyError:
+            # Workers started without --preload race to create it
+            if not inspect(db.engine).has_table(name):
+                raise
+            continue
+        created.append(name)
+        print("Created table {}".format(name))
+
+    if 'sensor_upload_stats' in created:
+        # Counting the files uploaded before the rollup existed scans all of
+        # sensor_files, too slow for every boot and CLI call to wait on
+        app.logger.warning(
+            "sensor_upload_stats is empty: run `flask backfill-upload-stats` "
+            "once, or upload counts and /api/sensor/stats leave out every "
+            "file uploaded before now")
+
+    db.engine.dispose()
+
+
+def create_indexes():
+    """Create the INDEXES that don't exist yet, returning their names"""
+
+    inspector = inspect(db.engine)
+    created = []
+    with db.engine.begin() as connection:
+        for name, table, columns in INDEXES:
+            if name in {i['name'] for i in inspector.get_indexes(table)}:
+                continue
+            connection.execute(text('CREATE INDEX {} ON {} ({})'.format(
+                name, table, ', '.join(columns))))
+            created.append(name)
+    return created
+
+
+@app.cli.command('create-indexes')
+def create_indexes_command():
+    """Create the sensor table indexes the app's queries rely on."""
+
+    for name in create_indexes():
+        click.echo('Created {}'.format(name))
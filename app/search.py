@@ -0,0 +1,292 @@
+import re
+import threading
+
+import click
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.dialects.mysql import match as mysql_match
+
+from app import app, db
+from app.models import Datatype, Device, Sensor, Tag
+
+# What /api/search looks through: (kind, table, id column, name column).
+# Sensors, devices and locations are limited to the caller's devices,
+# tags and datatypes are shared by everyone.
+KINDS = [
+    ('sensor', 'sensors', Sensor.sensor_id, Sensor.sensor_name),
+    ('device', 'devices', Device.device_id, Device.device_name),
+    ('location', 'devices', Device.device_id, Device.location),
+    ('tag', 'oc_systemtag', Tag.tag_id, Tag.tag_name),
+    ('datatype', 'datatypes', Datatype.datatype_id, Datatype.datatype_name)
+]
+KIND_NAMES = [kind for kind, _, _, _ in KINDS]
+
+# Tables above that belong to Nextcloud. Its upgrades don't expect indexes
+# or triggers of ours on them, so create-search-indexes leaves them alone
+# unless given --nextcloud-tables, and their kinds are searched with LIKE.
+NEXTCLOUD_TABLES = {'oc_systemtag'}
+
+# B-tree indexes for exact and prefix filters, as (name, table, column)
+BTREE_INDEXES = [
+    ('ix_sensors_name', 'sensors', 'name'),
+    ('ix_devices_name', 'devices', 'name'),
+    ('ix_devices_location', 'devices', 'location'),
+    ('ix_datatypes_name', 'datatypes', 'name')
+]
+
+# SQLite full-text table, kept in step with the source tables by triggers
+FTS_TABLE = 'search_fts'
+
+# How a name matches the query, best first: all of it, its start, or a
+# word in it
+EXACT, PREFIX, WORD = 3, 2, 1
+
+_backend = None
+_fulltext = None
+_backend_lock = threading.Lock()
+
+
+def fulltext_index(kind):
+    return 'ft_{}_{}'.format(kind, 'name' if kind != 'location' else 'loc')
+
+
+def terms(q):
+    # Words only: every other character means something to MATCH
+    return re.findall(r'\w+', q)
+
+
+def fts5_kinds(connection):
+    """Kinds kept in the SQLite full-text table by triggers"""
+
+    triggers = {name for name, in connection.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger'"))}
+    return {kind for kind in KIND_NAMES
+            if '{}_{}_ai'.format(FTS_TABLE, kind) in triggers}
+
+
+def backend():
+    """The search backend of this database, detected on first use.
+
+    Returns (name, kinds with a full-text index); the other kinds are
+    searched with LIKE. Indexes created while the server runs are picked
+    up after a restart.
+    """
+    global _backend, _fulltext
+
+    with _backend_lock:
+        if _backend is None:
+            configured = app.config['SEARCH_BACKEND']
+            dialect = db.engine.dialect.name
+            inspector = inspect(db.engine)
+            _fulltext = set()
+            if dialect == 'mysql' and configured in ('auto', 'fulltext'):
+                for kind, table, _, _ in KINDS:
+                    names = {i['name'] for i in inspector.get_indexes(table)}
+                    if fulltext_index(kind) in names:
+                        _fulltext.add(kind)
+                _backend = 'fulltext' if _fulltext else 'like'
+            elif dialect == 'sqlite' and configured in ('auto', 'fts5') \
+                    and inspector.has_table(FTS_TABLE):
+                with db.engine.connect() as connection:
+                    _fulltext = fts5_kinds(connection)
+                _backend = 'fts5' if _fulltext else 'like'
+            else:
+                _backend = 'like'
+    return _backend, _fulltext
+
+
+def owned(statement, kind, uid):
+    if kind == 'sensor':
+        statement = statement.join(
+            Device, Sensor.device_id == Device.device_id)
+    if kind in ('sensor', 'device', 'location'):
+        statement = statement.filter(Device.uid == uid)
+    return statement
+
+
+def like_search(q, kind, id_column, name_column, uid, limit):
+    # Prefix match, which the B-tree index on the name column can serve
+    statement = select(id_column, name_column)\
+        .filter(name_column.startswith(q, autoescape=True))\
+        .order_by(func.length(name_column), name_column)\
+        .limit(limit)
+    # Shortest first, so the closest prefixes lead
+    return [
+        dict(kind=kind, id=ref_id, name=name)
+        for ref_id, name in db.session.execute(owned(statement, kind, uid))
+    ]
+
+
+def fulltext_search(words, kind, id_column, name_column, uid, limit):
+    # Every word must appear, as a word or the start of one
+    against = ' '.join('+{}*'.format(word) for word in words)
+    score = mysql_match(name_column, against=against).in_boolean_mode()
+    statement = select(id_column, name_column, score.label('score'))\
+        .filter(score)\
+        .order_by(score.desc())\
+        .limit(limit)
+    return [
+        dict(kind=kind, id=ref_id, name=name)
+        for ref_id, name, rank in db.session.execute(
+            owned(statement, kind, uid))
+    ]
+
+
+def fts5_search(words, kinds, uid, limit):
+    query = ' '.join('"{}"*'.format(word) for word in words)
+    rows = db.session.execute(text(
+        "SELECT {fts}.kind, {fts}.ref_id, {fts}.body, bm25({fts}) AS rank "
+        "FROM {fts} "
+        "LEFT JOIN sensors s "
+        "  ON {fts}.kind = 'sensor' AND s.sensor_id = {fts}.ref_id "
+        "LEFT JOIN devices d ON d.device_id = CASE {fts}.kind "
+        "  WHEN 'sensor' THEN s.device_id ELSE {fts}.ref_id END "
+        "  AND {fts}.kind IN ('sensor', 'device', 'location') "
+        "WHERE {fts} MATCH :query AND {fts}.kind IN ({kinds}) "
+        "AND ({fts}.kind IN ('tag', 'datatype') OR d.uid = :uid) "
+        "ORDER BY rank LIMIT :limit".format(
+            fts=FTS_TABLE, kinds=', '.join("'%s'" % k for k in kinds))
+    ), {'query': query, 'uid': uid, 'limit': limit})
+    # bm25() is lower for better matches
+    return [
+        dict(kind=kind, id=ref_id, name=name)
+        for kind, ref_id, name, rank in rows
+    ]
+
+
+def match_tier(q, name):
+    q, name = q.casefold(), name.casefold()
+    if name == q:
+        return EXACT
+    if name.startswith(q):
+        return PREFIX
+    return WORD
+
+
+def ranked(q, results):
+    """Score the results of one backend query, which come best first.
+
+    LIKE, MATCH and bm25() relevance aren't comparable, so the score is
+    the tier of the match, plus up to 0.5 for the result's place in its
+    backend's order, which only breaks ties within a tier.
+    """
+    for position, result in enumerate(results):
+        result['score'] = match_tier(q, result['name']) + 1 / (2 + position)
+    return results
+
+
+def search(q, uid, kinds=None, limit=20):
+    """Ranked name matches across sensors, devices, locations, tags and
+    datatypes, best first"""
+
+    kinds = [kind for kind in KIND_NAMES if not kinds or kind in kinds]
+    words = terms(q)
+    name, fulltext = backend()
+
+    results = []
+    if name == 'fts5':
+        indexed = [kind for kind in kinds if kind in fulltext]
+        if words and indexed:
+            results += ranked(q, fts5_search(words, indexed, uid, limit))
+        kinds = [kind for kind in kinds if kind not in fulltext]
+
+    for kind, _, id_column, name_column in KINDS:
+        if kind not in kinds:
+            continue
+        if kind in fulltext and words:
+            results += ranked(q, fulltext_search(
+                words, kind, id_column, name_column, uid, limit))
+        else:
+            results += ranked(q, like_search(
+                q, kind, id_column, name_column, uid, limit))
+    results.sort(key=lambda result: result['score'], reverse=True)
+    return results[:limit]
+
+
+def create_fts5(connection, kinds):
+    connection.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS " + FTS_TABLE + " USING fts5("
+        "kind UNINDEXED, ref_id UNINDEXED, body, tokenize = 'unicode61')"))
+    connection.execute(text("DELETE FROM " + FTS_TABLE))
+    for kind, table, id_column, name_column in KINDS:
+        if kind not in kinds:
+            continue
+        id_name, body = id_column.name, name_column.name
+        connection.execute(text(
+            "INSERT INTO {fts} (kind, ref_id, body) "
+            "SELECT '{kind}', {id}, {body} FROM {table} "
+            "WHERE {body} IS NOT NULL".format(
+                fts=FTS_TABLE, kind=kind, id=id_name, body=body, table=table)))
+        statements = {
+            'ai': "AFTER INSERT ON {table} WHEN NEW.{body} IS NOT NULL BEGIN "
+                  "INSERT INTO {fts} (kind, ref_id, body) "
+                  "VALUES ('{kind}', NEW.{id}, NEW.{body}); END",
+            'ad': "AFTER DELETE ON {table} BEGIN "
+                  "DELETE FROM {fts} WHERE kind = '{kind}' "
+                  "AND ref_id = OLD.{id}; END",
+            'au': "AFTER UPDATE OF {body} ON {table} BEGIN "
+                  "DELETE FROM {fts} WHERE kind = '{kind}' "
+                  "AND ref_id = OLD.{id}; "
+                  "INSERT INTO {fts} (kind, ref_id, body) "
+                  "SELECT '{kind}', NEW.{id}, NEW.{body} "
+                  "WHERE NEW.{body} IS NOT NULL; END"
+        }
+        for event, statement in statements.items():
+            connection.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS {fts}_{kind}_{event} ".format(
+                    fts=FTS_TABLE, kind=kind, event=event)
+                + statement.format(fts=FTS_TABLE, kind=kind, id=id_name,
+                                   body=body, table=table)))
+
+
+def index_length(inspector, table, column):
+    # MySQL can only index a prefix of long and TEXT columns
+    for info in inspector.get_columns(table):
+        if info['name'] == column:
+            length = getattr(info['type'], 'length', None)
+            if length is None or length > 191:
+                return '(191)'
+    return ''
+
+
+@app.cli.command('create-search-indexes')
+@click.option('--nextcloud-tables', is_flag=True,
+              help="Also index Nextcloud's own tables ({}), which alters "
+                   "them.".format(', '.join(sorted(NEXTCLOUD_TABLES))))
+def create_search_indexes(nextcloud_tables):
+    """Create the name indexes used by filters and /api/search."""
+
+    if nextcloud_tables:
+        click.echo(
+            "Warning: adding indexes to Nextcloud's tables ({}). Nextcloud "
+            "doesn't know about them; check them again after upgrading "
+            "it.".format(', '.join(sorted(NEXTCLOUD_TABLES))), err=True)
+    kinds = {kind for kind, table, _, _ in KINDS
+             if nextcloud_tables or table not in NEXTCLOUD_TABLES}
+
+    inspector = inspect(db.engine)
+    dialect = db.engine.dialect.name
+    with db.engine.begin() as connection:
+        for name, table, column in BTREE_INDEXES:
+            if name in {i['name'] for i in inspector.get_indexes(table)}:
+                continue
+            length = ''
+            if dialect == 'mysql':
+                length = index_length(inspector, table, column)
+            connection.execute(text('CREATE INDEX {} ON {} ({}{})'.format(
+                name, table, column, length)))
+            click.echo('Created {}'.format(name))
+
+        if dialect == 'mysql':
+            for kind, table, _, name_column in KINDS:
+                name = fulltext_index(kind)
+                if kind not in kinds or name in {
+                        i['name'] for i in inspector.get_indexes(table)}:
+                    continue
+                connection.execute(text(
+                    'ALTER TABLE {} ADD FULLTEXT INDEX {} ({})'.format(
+                        table, name, name_column.name)))
+                click.echo('Created {}'.format(name))
+        elif dialect == 'sqlite':
+            # Kinds whose triggers are already in place stay indexed
+            create_fts5(connection, kinds | fts5_kinds(connection))
+            click.echo('Created and filled {}'.format(FTS_TABLE))
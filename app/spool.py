@@ -0,0 +1,413 @@
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from cryptography.fernet import Fernet, InvalidToken
+from sqlalchemy.exc import (DisconnectionError, OperationalError,
+                            SQLAlchemyError)
+
+from app import app, db, dedup
+from app.metrics import phase
+from app.models import Tag
+from app.uploads import (UploadStream, check_sha256, find_uploaded_file,
+                         gzipped, link_duplicate, push_to_nextcloud,
+                         record_sensor_file)
+
+# Job states, in the order a job normally moves through them
+QUEUED = 'queued'
+UPLOADING = 'uploading'
+DONE = 'done'
+FAILED = 'failed'
+
+# Nextcloud answers besides 5xx that a later attempt may get past:
+# timeout, WebDAV lock, rate limit
+RETRY_STATUSES = (408, 423, 429)
+
+# Job fields that are never written back out by get_job
+PRIVATE_FIELDS = ('credentials', 'endpoint')
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_recovered_pid = None
+
+
+def spool_dir():
+    path = app.config['UPLOAD_SPOOL_DIR']
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+def _path(job_id, suffix):
+    return os.path.join(spool_dir(), job_id + suffix)
+
+
+def _fernet():
+    # Keyed on the JWT secret, which has to stay the same across restarts
+    # anyway for issued tokens to remain valid
+    secret = app.config['JWT_SECRET_KEY']
+    if isinstance(secret, str):
+        secret = secret.encode('utf-8')
+    key = hashlib.sha256(b'upload-spool:' + secret).digest()
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def seal_credentials(user, password):
+    return _fernet().encrypt(
+        json.dumps([user, password]).encode('utf-8')).decode('ascii')
+
+
+def open_credentials(token):
+    """(user, password) of a job, raising InvalidToken when they were
+    sealed under another JWT_SECRET_KEY"""
+
+    return tuple(json.loads(_fernet().decrypt(token.encode('ascii'))))
+
+
+def _write_job(job):
+    # Write to a temporary file and rename it over the old one, so a crash
+    # never leaves a half-written job behind. Jobs hold WebDAV credentials,
+    # encrypted, until they finish, hence the restrictive mode too.
+    tmp = _path(job['job_id'], '.json.tmp')
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(job, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, _path(job['job_id'], '.json'))
+
+
+def _read_job(job_id):
+    try:
+        with open(_path(job_id, '.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def get_executor():
+    global _executor, _executor_pid
+
+    # Threads do not survive a fork, so every worker process gets its own pool
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=app.config['UPLOAD_SPOOL_WORKERS'],
+                thread_name_prefix='upload-spool'
+            )
+            _executor_pid = os.getpid()
+    return _executor
+
+
+def create_job(stream, uid, user, password, sensor_id, endpoint, path,
+               tag_id=None, length=None, max_length=None, compress=False,
+               sha256=None):
+    """Spool an upload body to local disk and queue it for Nextcloud.
+    With compress, the spooled copy is already gzipped as it will be
+    stored. sha256 is the hash the client says the body has."""
+
+    job_id = uuid.uuid4().hex
+    body = UploadStream(
+        stream,
+        length=length,
+        max_length=max_length,
+        chunk_size=app.config['UPLOAD_CHUNK_SIZE'])
+
+    source = gzipped(body) if compress else body
+
+    part = _path(job_id, '.part')
+    f = open(part, 'wb')
+    try:
+        # Held until the body is renamed into place, so that recover() can
+        # tell a .part still in use from one left by a crash
+        fcntl.flock(f, fcntl.LOCK_EX)
+        size = 0
+        for chunk in source:
+            f.write(chunk)
+            size += len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+
+        expected, sha256 = sha256, body.sha256.hexdigest()
+        check_sha256(expected, sha256)
+        existing = dedup.find_duplicate(sensor_id, sha256)
+        if existing:
+            os.remove(part)
+            return duplicate_job(
+                job_id, uid, sensor_id, tag_id, path, existing)
+
+        now = time.time()
+        job = dict(
+            job_id=job_id,
+            state=QUEUED,
+            uid=uid,
+            credentials=seal_credentials(user, password),
+            sensor_id=sensor_id,
+            tag_id=tag_id,
+            endpoint=endpoint,
+            path=path,
+            sha256=sha256,
+            bytes_total=size,
+            bytes_sent=0,
+            attempts=0,
+            file_id=None,
+            error=None,
+            created_at=now,
+            updated_at=now
+        )
+        _write_job(job)
+        # The job is only picked up once its data file exists
+        os.replace(part, _path(job_id, '.data'))
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    finally:
+        f.close()
+
+    submit(job_id)
+    return public_job(job)
+
+
+def duplicate_job(job_id, uid, sensor_id, tag_id, path, file_id):
+    # Nothing to push: the job is done as soon as it is created, pointing
+    # at the file the sensor already had
+    if tag_id is not None:
+        link_duplicate(file_id, Tag.query.filter_by(tag_id=tag_id).first())
+        db.session.commit()
+    now = time.time()
+    job = dict(
+        job_id=job_id,
+        state=DONE,
+        uid=uid,
+        sensor_id=sensor_id,
+        tag_id=tag_id,
+        path=path,
+        duplicate=True,
+        attempts=0,
+        file_id=file_id,
+        error=None,
+        created_at=now,
+        updated_at=now
+    )
+    _write_job(job)
+    return public_job(job)
+
+
+def public_job(job):
+    return {k: v for k, v in job.items() if k not in PRIVATE_FIELDS}
+
+
+def get_job(job_id):
+    if not job_id.isalnum():
+        return None
+    job = _read_job(job_id)
+    if job is None:
+        return None
+    return public_job(job)
+
+
+def submit(job_id):
+    get_executor().submit(run_job, job_id)
+
+
+def _retry_later(job_id, attempts):
+    delay = min(
+        app.config['UPLOAD_SPOOL_RETRY_DELAY'] * 2 ** (attempts - 1),
+        app.config['UPLOAD_SPOOL_MAX_RETRY_DELAY'])
+    timer = threading.Timer(delay, submit, args=(job_id,))
+    timer.daemon = True
+    timer.start()
+
+
+class _ProgressFile(object):
+    """Spooled data file that records upload progress as it is read"""
+
+    def __init__(self, f, job):
+        self.f = f
+        self.job = job
+        self.len = job['bytes_total']
+        self._saved_at = time.monotonic()
+
+    def read(self, size=-1):
+        chunk = self.f.read(size)
+        self.job['bytes_sent'] += len(chunk)
+        if time.monotonic() - self._saved_at > 1:
+            self.job['updated_at'] = time.time()
+            _write_job(self.job)
+            self._saved_at = time.monotonic()
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(app.config['UPLOAD_CHUNK_SIZE'])
+            if not chunk:
+                break
+            yield chunk
+
+
+def run_job(job_id):
+    # An exclusive lock on the job keeps workers sharing the spool from
+    # pushing the same file twice. The kernel drops it if the worker dies.
+    lock = open(_path(job_id, '.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return
+
+    try:
+        job = _read_job(job_id)
+        if job is None or job['state'] in (DONE, FAILED):
+            return
+        if not os.path.exists(_path(job_id, '.data')):
+            return
+        with app.app_context():
+            _run_job(job)
+    finally:
+        # The lock file itself stays until the job expires; removing it here
+        # would let two workers lock two different files for the same job
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+def _run_job(job):
+    job_id = job['job_id']
+    job['state'] = UPLOADING
+    job['attempts'] += 1
+    job['bytes_sent'] = 0
+    job['updated_at'] = time.time()
+    _write_job(job)
+
+    try:
+        user, password = open_credentials(job['credentials'])
+    except (InvalidToken, ValueError):
+        _finish(job, FAILED, error="Can't read the job's credentials, "
+                                   "was JWT_SECRET_KEY changed?")
+        return
+
+    try:
+        with open(_path(job_id, '.data'), 'rb') as f:
+            response = push_to_nextcloud(
+                job['endpoint'], user, password, _ProgressFile(f, job))
+
+        file = find_uploaded_file(response, job['uid'], job['path'])
+        if not file:
+            raise LookupError("Uploaded file not found in the filecache")
+        tag = None
+        if job['tag_id'] is not None:
+            tag = Tag.query.filter_by(tag_id=job['tag_id']).first()
+        file_id = file.file_id
+        record_sensor_file(file, job['sensor_id'], tag, job.get('sha256'))
+        with phase('commit'):
+            db.session.commit()
+    except (requests.ConnectionError, requests.Timeout) as e:
+        _requeue(job, str(e))
+        return
+    except requests.HTTPError as e:
+        # Nextcloud being down, overloaded or busy with the file is worth
+        # retrying, anything it refuses outright is not
+        status = getattr(e.response, 'status_code', None) or 0
+        if status >= 500 or status in RETRY_STATUSES:
+            _requeue(job, str(e))
+        else:
+            _finish(job, FAILED, error=str(e))
+        return
+    except (OperationalError, DisconnectionError) as e:
+        # The database is down or the connection dropped
+        db.session.rollback()
+        _requeue(job, str(e.__dict__.get('orig', e)))
+        return
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        _finish(job, FAILED, error=str(e.__dict__.get('orig', e)))
+        return
+    except Exception as e:
+        db.session.rollback()
+        _finish(job, FAILED, error=str(e))
+        return
+    finally:
+        db.session.remove()
+
+    _finish(job, DONE, file_id=file_id)
+
+
+def _requeue(job, error):
+    # However long the outage, the body stays spooled: the client was told
+    # it would get there
+    job['state'] = QUEUED
+    job['error'] = error
+    job['updated_at'] = time.time()
+    _write_job(job)
+    _retry_later(job['job_id'], job['attempts'])
+
+
+def _finish(job, state, file_id=None, error=None):
+    job['state'] = state
+    job['file_id'] = file_id
+    job['error'] = error
+    job['updated_at'] = time.time()
+    for field in PRIVATE_FIELDS:
+        job.pop(field, None)
+    _write_job(job)
+    try:
+        os.remove(_path(job['job_id'], '.data'))
+    except OSError:
+        pass
+
+
+def recover():
+    """Requeue jobs left unfinished by a previous run and drop old ones.
+    Runs once per worker process; later calls do nothing."""
+    global _recovered_pid
+
+    with _executor_lock:
+        if _recovered_pid == os.getpid():
+            return
+        _recovered_pid = os.getpid()
+
+    now = time.time()
+    retention = app.config['UPLOAD_SPOOL_RETENTION']
+    for name in os.listdir(spool_dir()):
+        if name.endswith('.part'):
+            _remove_orphan(os.path.join(spool_dir(), name))
+            continue
+        if not name.endswith('.json'):
+            continue
+        job_id = name[:-len('.json')]
+        job = _read_job(job_id)
+        if job is None:
+            continue
+        if job['state'] in (QUEUED, UPLOADING):
+            submit(job_id)
+        elif now - job['updated_at'] > retention:
+            for suffix in ('.json', '.lock'):
+                try:
+                    os.remove(_path(job_id, suffix))
+                except OSError:
+                    pass
+
+
+def _remove_orphan(part):
+    # A body whose upload never got an answer, left by a worker that died
+    # while spooling it; the lock is only free then
+    try:
+        f = open(part, 'rb')
+    except OSError:
+        return
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        try:
+            os.remove(part)
+        except OSError:
+            pass
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import Counter
+
+from flask import g, has_request_context
+from sqlalchemy import event
+
+from app import app, db
+from app.metrics import endpoint_label, record
+
+# Per endpoint totals of this worker since it started
+summaries = {}
+_summaries_lock = threading.Lock()
+
+
+def _short(value, limit=1000):
+    text = repr(value)
+    return text if len(text) <= limit else text[:limit] + '...'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    context.profile_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.perf_counter() - context.profile_started
+
+    if elapsed * 1000 >= app.config['SQL_SLOW_QUERY_MS']:
+        app.logger.warning(
+            'Slow query (%.1f ms) on %s: %s; parameters: %s',
+            elapsed * 1000,
+            endpoint_label() if has_request_context() else 'background',
+            ' '.join(statement.split()),
+            _short(parameters))
+        if has_request_context():
+            g.setdefault('sql_slow', 0)
+            g.sql_slow += 1
+
+    if has_request_context():
+        stats = g.setdefault('sql_stats', {
+            'queries': 0, 'seconds': 0.0, 'statements': Counter()})
+        stats['queries'] += 1
+        stats['seconds'] += elapsed
+        stats['statements'][statement] += 1
+        record('sql', elapsed)
+
+
+def summarize(response):
+    """Fold the queries of a request into its endpoint's summary, and
+    warn about statements it ran over and over"""
+
+    stats = g.get('sql_stats')
+    if stats is None:
+        return response
+
+    endpoint = endpoint_label()
+    threshold = app.config['SQL_REPEAT_THRESHOLD']
+    repeated = [
+        (statement, count)
+        for statement, count in stats['statements'].most_common()
+        if count >= threshold
+    ]
+    for statement, count in repeated:
+        app.logger.warning(
+            'Possible N+1 on %s: statement ran %d times in one request: %s',
+            endpoint, count, ' '.join(statement.split()))
+
+    with _summaries_lock:
+        summary = summaries.setdefault(endpoint, dict(
+            requests=0, queries=0, max_queries=0, seconds=0.0,
+            slow_queries=0, repeated=Counter()))
+        summary['requests'] += 1
+        summary['queries'] += stats['queries']
+        summary['max_queries'] = max(summary['max_queries'], stats['queries'])
+        summary['seconds'] += stats['seconds']
+        summary['slow_queries'] += g.get('sql_slow', 0)
+        for statement, count in repeated:
+            summary['repeated'][' '.join(statement.split())] += 1
+
+    response.headers['X-SQL-Queries'] = str(stats['queries'])
+    response.headers['X-SQL-Time'] = '{:.1f}'.format(stats['seconds'] * 1000)
+    return response
+
+
+def report():
+    """Per endpoint query counts and database time, busiest first"""
+
+    with _summaries_lock:
+        items = [(endpoint, dict(summary, repeated=Counter(summary['repeated'])))
+                 for endpoint, summary in summaries.items()]
+
+    results = []
+    for endpoint, summary in items:
+        requests = summary['requests']
+        results.append(dict(
+            endpoint=endpoint,
+            requests=requests,
+            queries=summary['queries'],
+            avg_queries=round(summary['queries'] / requests, 2),
+            max_queries=summary['max_queries'],
+            db_ms=round(summary['seconds'] * 1000, 1),
+            avg_db_ms=round(summary['seconds'] * 1000 / requests, 2),
+            slow_queries=summary['slow_queries'],
+            # Statements that repeated within a request, and in how many
+            repeated=[
+                dict(statement=statement, requests=count)
+                for statement, count in summary['repeated'].most_common(5)
+            ]
+        ))
+    results.sort(key=lambda result: result['db_ms'], reverse=True)
+    return results
+
+
+def enable():
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+    # Rows a streamed response fetches after this point are not counted
+    app.after_request(summarize)
+
+
+if app.config['SQL_PROFILE']:
+    enable()
@@ -0,0 +1,58 @@
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import chain
+from json import dumps
+
+from flask import Response, stream_with_context
+
+from app import app, db
+
+
+def json_serial(obj):
+    """JSON serializer for objects not serializable by default json code"""
+
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        # MySQL returns SUM() and friends as DECIMAL
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    raise TypeError ("Type %s not serializable" % type(obj))
+
+
+def stream_rows(statement):
+    """Execute statement on a server-side cursor, fetching rows in batches"""
+
+    result = db.session.execute(
+        statement,
+        execution_options={'stream_results': True}
+    )
+    return result.yield_per(app.config['STREAM_YIELD_PER'])
+
+
+def peek(rows):
+    """Return (first row, iterator over all rows), or (None, None) if empty"""
+
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return None, None
+    return first, chain([first], rows)
+
+
+def json_list_response(rows, to_dict, status=200, headers=None):
+    """Chunked JSON array response, encoding each row as it is fetched"""
+
+    def generate():
+        yield '['
+        for i, row in enumerate(rows):
+            if i:
+                yield ','
+            yield dumps(to_dict(row), default=json_serial)
+        yield ']'
+
+    return Response(
+        stream_with_context(generate()),
+        status=status,
+        mimetype='application/json',
+        headers=headers
+    )
@@ -0,0 +1,299 @@
+import gzip
+import hashlib
+import re
+import tempfile
+import zlib
+from datetime import datetime
+
+import requests
+from requests.auth import HTTPBasicAuth
+from werkzeug.exceptions import (BadRequest, HTTPException,
+                                 RequestEntityTooLarge)
+
+from app import app, dedup, db, nextcloud, refdata, rollups
+from app.metrics import phase
+from app.models import File, SensorFile, Storage, add_file_tag, file_has_tag
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DECODE_ERRORS = (OSError, EOFError, zlib.error)
+if zstandard is not None:
+    DECODE_ERRORS += (zstandard.ZstdError,)
+
+
+class UploadStream(object):
+    """File-like wrapper that hands the request body to requests in
+    bounded chunks instead of reading it into memory in one go.
+
+    Counts the bytes passing through and raises a 413 as soon as they
+    exceed max_length, so the limit holds for chunked uploads too. The
+    SHA-256 of everything read is kept in sha256, and the HTTP error a
+    read raised, if any, in error.
+    """
+
+    def __init__(self, stream, length=None, max_length=None,
+                 chunk_size=64 * 1024):
+        self.stream = stream
+        self.max_length = max_length
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self.sha256 = hashlib.sha256()
+        self.error = None
+        # requests checks `len` to decide between a Content-Length and
+        # a chunked transfer; leave it as None when the size is unknown
+        self.len = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        try:
+            chunk = self.stream.read(size)
+            self.bytes_read += len(chunk)
+            if self.max_length is not None \
+                    and self.bytes_read > self.max_length:
+                raise RequestEntityTooLarge()
+        except HTTPException as e:
+            self.error = e
+            raise
+        self.sha256.update(chunk)
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class DecodingStream(object):
+    """Decompressing reader over a request body sent with a
+    Content-Encoding. Each read returns at most size decoded bytes, so a
+    small body can't expand into a large buffer."""
+
+    def __init__(self, stream, encoding, chunk_size=64 * 1024):
+        if encoding in ('gzip', 'x-gzip'):
+            # GzipFile inflates incrementally and handles multiple members
+            self.reader = gzip.GzipFile(fileobj=stream, mode='rb')
+        elif encoding == 'zstd':
+            self.reader = zstandard.ZstdDecompressor().stream_reader(
+                stream, read_size=chunk_size)
+        else:
+            raise ValueError(encoding)
+
+    def read(self, size=-1):
+        try:
+            return self.reader.read(size)
+        except DECODE_ERRORS:
+            raise BadRequest(
+                "Request body is not valid for its Content-Encoding")
+
+
+class GzipStream(object):
+    """File-like gzip encoder over another stream, compressing a chunk at
+    a time as requests reads from it"""
+
+    def __init__(self, stream, level=6, chunk_size=64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self._compressor = zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._buffer = bytearray()
+        self._done = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        while len(self._buffer) < size and not self._done:
+            chunk = self.stream.read(self.chunk_size)
+            if chunk:
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._done = True
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def supported_encodings():
+    encodings = ['identity', 'gzip', 'x-gzip']
+    if zstandard is not None:
+        encodings.append('zstd')
+    return encodings
+
+
+def store_compressed(datatype_id):
+    """Whether uploads of a datatype are gzipped before going to Nextcloud"""
+
+    if datatype_id not in app.config['STORE_COMPRESSED_DATATYPE_IDS']:
+        return False
+    for datatype in refdata.datatypes.rows():
+        if datatype['datatype_id'] == datatype_id:
+            return bool(datatype['is_large'])
+    return False
+
+
+def gzipped(stream):
+    """A stream gzipped as it is read, for storing compressed"""
+
+    return GzipStream(
+        stream,
+        level=app.config['STORE_COMPRESSED_LEVEL'],
+        chunk_size=app.config['UPLOAD_CHUNK_SIZE'])
+
+
+def with_length(body):
+    """body, or a buffered copy of it when its size isn't known and
+    NEXTCLOUD_CHUNKED_UPLOADS is off: many PHP-FPM setups refuse a chunked
+    PUT, so it goes out with a Content-Length instead"""
+
+    if getattr(body, 'len', None) is not None \
+            or app.config['NEXTCLOUD_CHUNKED_UPLOADS']:
+        return body
+    return buffer_to_length(
+        body,
+        app.config['UPLOAD_BUFFER_MEMORY'],
+        app.config['UPLOAD_CHUNK_SIZE'])
+
+
+def buffer_to_length(stream, max_memory, chunk_size=64 * 1024):
+    """Read a stream to the end, in memory up to max_memory bytes and on
+    disk past that. Returns an UploadStream over the copy with its length
+    set, so that it goes out with a Content-Length."""
+
+    buffered = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffered.write(chunk)
+        size += len(chunk)
+    buffered.seek(0)
+    return UploadStream(buffered, length=size, chunk_size=chunk_size)
+
+
+def buffer_body(body, max_memory):
+    """Buffer an UploadStream so its hash is known before it is sent on.
+    Returns a stream over the buffered copy and the hex SHA-256."""
+
+    stream = buffer_to_length(body, max_memory, body.chunk_size)
+    return stream, body.sha256.hexdigest()
+
+
+def sha256_of(stream, chunk_size=64 * 1024):
+    """Hex SHA-256 of a seekable stream, which is left rewound"""
+
+    body = UploadStream(stream, chunk_size=chunk_size)
+    for _ in body:
+        pass
+    stream.seek(0)
+    return body.sha256.hexdigest()
+
+
+def check_sha256(expected, sha256):
+    """Refuse a body whose hash isn't the one the client sent"""
+
+    if expected is not None and expected.lower() != sha256:
+        raise BadRequest("Request body doesn't match its sha256 header")
+
+
+def push_to_nextcloud(endpoint, user, password, body, source=None):
+    """PUT body to WebDAV, timed as the 'webdav' phase"""
+
+    with phase('webdav'):
+        return put_to_nextcloud(endpoint, user, password, body, source)
+
+
+def put_to_nextcloud(endpoint, user, password, body, source=None):
+    """PUT body to WebDAV. source is the UploadStream body is read from;
+    an error it raised part way through the send, such as a body that
+    doesn't decode, reaches the client as itself however requests passed
+    it on."""
+
+    try:
+        response = nextcloud.put(
+            endpoint,
+            auth=HTTPBasicAuth(user, password),
+            data=body,
+        )
+    except Exception as e:
+        error = getattr(source, 'error', None)
+        if error is not None and error is not e:
+            raise error from e
+        raise
+    response.raise_for_status()
+    return response
+
+
+def remove_from_nextcloud(endpoint, user, password):
+    """Delete a file just uploaded, returning whether Nextcloud did. It
+    goes to the user's trash bin rather than away for good."""
+
+    with phase('webdav'):
+        try:
+            response = nextcloud.delete(
+                endpoint, auth=HTTPBasicAuth(user, password))
+        except requests.RequestException:
+            return False
+    return response.ok
+
+
+def home_storage_ids(uid):
+    # Home storage of a user on local disk and on primary object storage
+    return ['home::' + uid, 'object::user:' + uid]
+
+
+def find_uploaded_file(response, uid, path):
+    """Find the filecache entry of a file just PUT at path for uid"""
+
+    with phase('filecache'):
+        return _find_uploaded_file(response, uid, path)
+
+
+def _find_uploaded_file(response, uid, path):
+    # Nextcloud answers a WebDAV PUT with OC-FileId, the file id padded to
+    # eight digits followed by the instance id
+    match = re.match(r'\d+', response.headers.get('OC-FileId', ''))
+    if match:
+        file = File.query.filter_by(file_id=int(match.group())).first()
+        if file:
+            return file
+
+    # Otherwise look it up by the unique (storage, path_hash) index
+    internal_path = 'files/' + '/'.join(p for p in path.split('/') if p)
+    path_hash = hashlib.md5(internal_path.encode('utf-8')).hexdigest()
+    return File.query.join(Storage)\
+        .filter(Storage.storage_id.in_(home_storage_ids(uid)))\
+        .filter(File.path_hash == path_hash).first()
+
+
+def record_sensor_file(file, sensor_id, tag=None, sha256=None):
+    # upload_date is set here rather than by the database so that the
+    # rollup bucket always agrees with it
+    upload_date = datetime.now()
+    db.session.add(SensorFile(
+        file_id=file.file_id, sensor_id=sensor_id, upload_date=upload_date))
+    rollups.add_uploads(sensor_id, upload_date, 1, file.size)
+    dedup.remember(file.file_id, sensor_id, sha256, upload_date)
+    if tag:
+        add_file_tag(file.file_id, tag.tag_id)
+
+
+def link_duplicate(file_id, tag=None):
+    """Apply an upload's tag to the earlier file it duplicates"""
+
+    if tag and not file_has_tag(file_id, tag.tag_id):
+        add_file_tag(file_id, tag.tag_id)
@@ -0,0 +1,24 @@
+# Server configuration for benchmark runs, passed as ENV_DIRECTORY by
+# bench/run.py. Starts from app/.env and points the database and Nextcloud
+# at the local stand-ins.
+import os
+
+_base = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', '.env')
+with open(_base) as _f:
+    exec(compile(_f.read(), _base, 'exec'))
+
+SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath(
+    os.environ['BENCH_DATABASE'])
+SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 30}}
+
+# The seeded schema matches app/models.py, no need to reflect it
+SCHEMA_REFLECT = False
+SCHEMA_CACHE_FILE = None
+
+NEXTCLOUD_USER_ENDPOINT = os.environ['BENCH_NEXTCLOUD'] + '/ocs/v1.php/cloud/users/'
+NEXTCLOUD_WEBDAV = os.environ['BENCH_NEXTCLOUD'] + '/remote.php/dav/files/'
+
+UPLOAD_SPOOL_DIR = os.environ.get('BENCH_SPOOL_DIR', UPLOAD_SPOOL_DIR)
+MAX_CONTENT_LENGTH = int(os.environ.get(
+    'BENCH_MAX_CONTENT_LENGTH', MAX_CONTENT_LENGTH))
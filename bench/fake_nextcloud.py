@@ -0,0 +1,306 @@
+"""Local stand-in for the Nextcloud endpoints the server calls.
+
+Answers the OCS user lookup used at login and WebDAV PUT, GET and DELETE
+under /remote.php/dav/files/<uid>/. Uploaded files are written to oc_filecache in
+the benchmark database, as Nextcloud would, and the PUT response carries
+ETag and OC-FileId headers. Every user's password is --password.
+
+    python bench/fake_nextcloud.py bench.db --port 8081 --latency 20
+"""
+import argparse
+import base64
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+OCS_PREFIX = '/ocs/v1.php/cloud/users/'
+DAV_PREFIX = '/remote.php/dav/files/'
+INSTANCE_ID = 'ocbench0000'
+
+OCS_USER = """<?xml version="1.0"?>
+<ocs>
+ <meta><status>ok</status><statuscode>100</statuscode><message>OK</message></meta>
+ <data><enabled>1</enabled><storageLocation>/data/{uid}</storageLocation><id>{uid}</id></data>
+</ocs>
+"""
+
+
+class FakeNextcloud(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, database, password='bench', latency=0,
+                 data_dir=None):
+        super().__init__(address, Handler)
+        self.database = database
+        self.password = password
+        self.latency = latency / 1000.0
+        # A data directory made here is removed again by server_close()
+        self.own_data_dir = data_dir is None
+        self.data_dir = data_dir or tempfile.mkdtemp(prefix='fake_nextcloud_')
+        self.db_lock = threading.Lock()
+        self.counts = dict(ocs=0, put=0, get=0, delete=0, chunked=0)
+
+    def connect(self):
+        connection = sqlite3.connect(self.database, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def server_close(self):
+        super().server_close()
+        if self.own_data_dir:
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def store(self, uid, path, body_file, size):
+        """Record an uploaded file in oc_filecache, returning (fileid, etag)"""
+
+        internal_path = 'files/' + '/'.join(p for p in path.split('/') if p)
+        path_hash = hashlib.md5(internal_path.encode('utf-8')).hexdigest()
+        etag = hashlib.md5(
+            '{}{}'.format(internal_path, time.time()).encode('utf-8')
+        ).hexdigest()
+        with self.db_lock:
+            connection = self.connect()
+            try:
+                storage = connection.execute(
+                    'SELECT numeric_id FROM oc_storages WHERE id = ?',
+                    ('home::' + uid,)).fetchone()
+                if storage is None:
+                    cursor = connection.execute(
+                        'INSERT INTO oc_storages (id) VALUES (?)',
+                        ('home::' + uid,))
+                    storage = (cursor.lastrowid,)
+                connection.execute(
+                    'INSERT INTO oc_filecache (storage, path, path_hash, '
+                    'name, mimetype, size, etag) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (storage, path_hash) DO UPDATE SET '
+                    'size = excluded.size, etag = excluded.etag',
+                    (storage[0], internal_path, path_hash,
+                     internal_path.rsplit('/', 1)[-1], 5, size, etag))
+                file_id = connection.execute(
+                    'SELECT fileid FROM oc_filecache '
+                    'WHERE storage = ? AND path_hash = ?',
+                    (storage[0], path_hash)).fetchone()[0]
+                connection.commit()
+            finally:
+                connection.close()
+        os.replace(body_file, os.path.join(self.data_dir, str(file_id)))
+        return file_id, etag
+
+    def remove(self, uid, path):
+        """Drop a file from oc_filecache, returning whether it was there"""
+
+        row = self.lookup(uid, path)
+        if row is None:
+            return False
+        with self.db_lock:
+            connection = self.connect()
+            try:
+                connection.execute(
+                    'DELETE FROM oc_filecache WHERE fileid = ?', (row[0],))
+                connection.commit()
+            finally:
+                connection.close()
+        try:
+            os.remove(os.path.join(self.data_dir, str(row[0])))
+        except OSError:
+            pass
+        return True
+
+    def lookup(self, uid, path):
+        internal_path = 'files/' + '/'.join(p for p in path.split('/') if p)
+        path_hash = hashlib.md5(internal_path.encode('utf-8')).hexdigest()
+        connection = self.connect()
+        try:
+            return connection.execute(
+                'SELECT f.fileid, f.etag FROM oc_filecache f '
+                'JOIN oc_storages s ON s.numeric_id = f.storage '
+                'WHERE s.id = ? AND f.path_hash = ?',
+                ('home::' + uid, path_hash)).fetchone()
+        finally:
+            connection.close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def credentials(self):
+        header = self.headers.get('Authorization', '')
+        if not header.startswith('Basic '):
+            return None, None
+        try:
+            user, _, password = base64.b64decode(header[6:])\
+                .decode('utf-8').partition(':')
+        except ValueError:
+            return None, None
+        return user, password
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def authorized(self, uid):
+        user, password = self.credentials()
+        return user == uid and password == self.server.password
+
+    def body_chunks(self):
+        # A body cut short raises ConnectionAbortedError; like Nextcloud, the
+        # stand-in then stores nothing
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            self.server.counts['chunked'] += 1
+            while True:
+                try:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                except ValueError:
+                    raise ConnectionAbortedError("Malformed chunked body")
+                if size == 0:
+                    self.rfile.readline()
+                    return
+                chunk = self.rfile.read(size)
+                if len(chunk) < size:
+                    raise ConnectionAbortedError("Body cut short")
+                yield chunk
+                self.rfile.readline()
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                raise ConnectionAbortedError("Body cut short")
+            remaining -= len(chunk)
+            yield chunk
+
+    def dav_target(self):
+        uid, _, path = unquote(self.path[len(DAV_PREFIX):]).partition('/')
+        return uid, path
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.path.startswith(OCS_PREFIX):
+            self.server.counts['ocs'] += 1
+            uid = unquote(self.path[len(OCS_PREFIX):])
+            if not self.authorized(uid):
+                return self.reply(401)
+            return self.reply(
+                200, OCS_USER.format(uid=uid).encode('utf-8'),
+                {'Content-Type': 'text/xml; charset=UTF-8'})
+
+        if self.path.startswith(DAV_PREFIX):
+            self.server.counts['get'] += 1
+            uid, path = self.dav_target()
+            if not self.authorized(uid):
+                return self.reply(401)
+            row = self.server.lookup(uid, path)
+            if row is None:
+                return self.reply(404)
+            data_path = os.path.join(self.server.data_dir, str(row[0]))
+            if not os.path.exists(data_path):
+                return self.reply(404)
+            with open(data_path, 'rb') as f:
+                body = f.read()
+            headers = {'ETag': '"{}"'.format(row[1])}
+            byte_range = self.headers.get('Range', '')
+            if byte_range.startswith('bytes='):
+                start, _, end = byte_range[6:].partition('-')
+                start = int(start or 0)
+                end = min(int(end) if end else len(body) - 1, len(body) - 1)
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                    start, end, len(body))
+                return self.reply(206, body[start:end + 1], headers)
+            return self.reply(200, body, headers)
+
+        return self.reply(404)
+
+    def do_PUT(self):
+        if not self.path.startswith(DAV_PREFIX):
+            return self.reply(405)
+        self.server.counts['put'] += 1
+        uid, path = self.dav_target()
+        if not self.authorized(uid):
+            try:
+                for _ in self.body_chunks():
+                    pass
+            except ConnectionAbortedError:
+                self.close_connection = True
+                return
+            return self.reply(401)
+
+        fd, body_file = tempfile.mkstemp(dir=self.server.data_dir)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in self.body_chunks():
+                    f.write(chunk)
+                    size += len(chunk)
+        except ConnectionAbortedError:
+            os.remove(body_file)
+            self.close_connection = True
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        file_id, etag = self.server.store(uid, path, body_file, size)
+        self.reply(201, headers={
+            'ETag': '"{}"'.format(etag),
+            'OC-ETag': '"{}"'.format(etag),
+            'OC-FileId': '{:08d}{}'.format(file_id, INSTANCE_ID)
+        })
+
+    def do_DELETE(self):
+        if not self.path.startswith(DAV_PREFIX):
+            return self.reply(405)
+        self.server.counts['delete'] += 1
+        uid, path = self.dav_target()
+        if not self.authorized(uid):
+            return self.reply(401)
+        if not self.server.remove(uid, path):
+            return self.reply(404)
+        self.reply(204)
+
+
+def serve(database, host='127.0.0.1', port=0, password='bench', latency=0):
+    """Start the stand-in on a background thread and return the server"""
+
+    server = FakeNextcloud((host, port), database, password, latency)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds added to every response')
+    args = parser.parse_args()
+
+    server = FakeNextcloud((args.host, args.port), args.database,
+                           args.password, args.latency)
+    print('Fake Nextcloud on http://{}:{}/'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
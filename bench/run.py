@@ -0,0 +1,331 @@
+"""Load test the server against local stand-ins for Nextcloud and MySQL.
+
+Seeds a SQLite database (unless it already exists), starts the fake
+Nextcloud from bench/fake_nextcloud.py and the server under gunicorn, then
+runs each scenario and reports latency percentiles, throughput and the
+peak RSS of the server processes.
+
+    python bench/run.py --scenarios login,upload,listing \\
+        --requests 2000 --concurrency 50 --latency 50 --worker-class gevent
+
+Scenarios:
+    login    POST /login, cycling through the seeded users
+    upload   PUT /api/file of --size random bytes to one of the user's sensors
+    listing  GET /api/filedetail, one page of --page-size rows
+
+Exits with status 1 when more than --max-error-rate of a scenario's
+requests fail, after printing a sample response of each kind of failure.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_nextcloud  # noqa: E402
+import seed  # noqa: E402
+
+SCENARIOS = ['login', 'upload', 'listing']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, database, nextcloud_url, port, spool_dir):
+    env = dict(
+        os.environ,
+        ENV_DIRECTORY=os.path.join(BENCH_DIR, 'config.py'),
+        BENCH_DATABASE=database,
+        BENCH_NEXTCLOUD=nextcloud_url,
+        BENCH_SPOOL_DIR=spool_dir,
+        BENCH_MAX_CONTENT_LENGTH=str(max(args.size * 2, 1024 * 1024)),
+        GUNICORN_BIND='127.0.0.1:{}'.format(port),
+        GUNICORN_WORKER_CLASS=args.worker_class,
+        GUNICORN_WORKERS=str(args.workers)
+    )
+    if args.server == 'flask':
+        command = [sys.executable, '-m', 'flask', 'run', '--with-threads',
+                   '--host', '127.0.0.1', '--port', str(port)]
+        env['FLASK_APP'] = 'elsdan_server.py'
+    else:
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                   'app:app']
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+
+    url = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('Server exited with {}'.format(process.returncode))
+        try:
+            requests.get(url + '/', timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit('Server did not start within 60s')
+
+
+def process_tree(pid):
+    pids = [pid]
+    for pid in pids:
+        try:
+            for task in os.listdir('/proc/{}/task'.format(pid)):
+                with open('/proc/{}/task/{}/children'.format(pid, task)) as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def peak_rss_kb(pid):
+    """Sum of the peak resident set size of a process and its children"""
+
+    total = 0
+    for pid in process_tree(pid):
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class Client(object):
+    """One keep-alive session per load generating thread"""
+
+    def __init__(self, url, args, users):
+        self.url = url
+        self.args = args
+        self.users = users
+        self.local = threading.local()
+        self.tokens = {}
+        self.body = os.urandom(args.size)
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def token(self, uid):
+        if uid not in self.tokens:
+            response = self.session().post(
+                self.url + '/login', auth=(uid, self.args.password))
+            response.raise_for_status()
+            self.tokens[uid] = response.json()['access_token']
+        return self.tokens[uid]
+
+    def login(self, i):
+        uid = self.users[i % len(self.users)][0]
+        return self.session().post(
+            self.url + '/login', auth=(uid, self.args.password))
+
+    def upload(self, i):
+        uid, sensor_ids = self.users[i % len(self.users)]
+        # Vary the first bytes so that deduplication doesn't skip the upload.
+        # Header names are hyphenated: the app reads sensor-id as sensor_id,
+        # and newer gunicorn releases drop names with underscores.
+        return self.session().put(
+            self.url + '/api/file',
+            data=os.urandom(16) + self.body[16:],
+            headers={
+                'Authorization': 'Bearer ' + self.token(uid),
+                'sensor-id': str(sensor_ids[i % len(sensor_ids)]),
+                'path': 'bench',
+                'extension': 'txt',
+                'user': uid,
+                'password': self.args.password
+            })
+
+    def listing(self, i):
+        uid = self.users[i % len(self.users)][0]
+        return self.session().get(
+            self.url + '/api/filedetail',
+            params={'limit': self.args.page_size},
+            headers={'Authorization': 'Bearer ' + self.token(uid)})
+
+
+def run_scenario(client, name, requests_count, concurrency):
+    call = getattr(client, name)
+    latencies, errors, samples = [], {}, {}
+    lock = threading.Lock()
+
+    def one(i):
+        start = time.perf_counter()
+        try:
+            response = call(i)
+            # Read the whole body, listings are streamed
+            detail = response.content[:200]
+            status = response.status_code
+        except requests.RequestException as e:
+            status, detail = type(e).__name__, str(e)
+        elapsed = time.perf_counter() - start
+        with lock:
+            if isinstance(status, int) and status < 400:
+                latencies.append(elapsed)
+            else:
+                errors[status] = errors.get(status, 0) + 1
+                # Keep one response of each kind to show what went wrong
+                samples.setdefault(str(status), repr(detail))
+
+    # Warm up the per-user tokens outside the timed run
+    for uid, _ in client.users:
+        client.token(uid)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests_count)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return dict(
+        scenario=name,
+        requests=requests_count,
+        concurrency=concurrency,
+        ok=len(latencies),
+        errors=errors,
+        error_rate=round(sum(errors.values()) / requests_count, 4),
+        error_samples=samples,
+        seconds=round(wall, 3),
+        throughput=round(len(latencies) / wall, 1) if wall else None,
+        p50_ms=_ms(percentile(latencies, 0.50)),
+        p90_ms=_ms(percentile(latencies, 0.90)),
+        p99_ms=_ms(percentile(latencies, 0.99)),
+        max_ms=_ms(latencies[-1] if latencies else None)
+    )
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def bench_users(database, count):
+    """(uid, [sensor ids]) of the first count seeded users"""
+
+    connection = sqlite3.connect(database)
+    try:
+        rows = connection.execute(
+            'SELECT d.uid, s.sensor_id FROM sensors s '
+            'JOIN devices d ON d.device_id = s.device_id '
+            'ORDER BY d.uid, s.sensor_id').fetchall()
+    finally:
+        connection.close()
+    users = {}
+    for uid, sensor_id in rows:
+        users.setdefault(uid, []).append(sensor_id)
+    return sorted(users.items())[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split('\n\n', 1)[1])
+    parser.add_argument('--database', default=os.path.join(BENCH_DIR, 'bench.db'))
+    parser.add_argument('--reseed', action='store_true')
+    parser.add_argument('--files', type=int, default=200000,
+                        help='files to seed')
+    parser.add_argument('--users', type=int, default=20,
+                        help='users to seed and to spread requests over')
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--size', type=int, default=64 * 1024,
+                        help='upload body size in bytes')
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds the fake Nextcloud adds per call')
+    parser.add_argument('--server', choices=['gunicorn', 'flask'],
+                        default='gunicorn')
+    parser.add_argument('--worker-class', default='gevent')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--max-error-rate', type=float, default=0,
+                        help='fraction of failed requests tolerated per '
+                             'scenario')
+    parser.add_argument('--json', help='also write the results here')
+    args = parser.parse_args()
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(name))
+
+    if args.reseed or not os.path.exists(args.database):
+        print('Seeding {}'.format(args.database))
+        seed.seed(args.database, users=args.users, devices=5, sensors=4,
+                  files=args.files, tags=50, tags_per_file=2, seed=1)
+
+    nextcloud = fake_nextcloud.serve(
+        args.database, password=args.password, latency=args.latency)
+    nextcloud_url = 'http://127.0.0.1:{}'.format(nextcloud.server_address[1])
+
+    spool_dir = tempfile.mkdtemp(prefix='elsdan_bench_spool_')
+    process, url = start_server(
+        args, args.database, nextcloud_url, free_port(), spool_dir)
+    results = []
+    try:
+        client = Client(url, args, bench_users(args.database, args.users))
+        for name in scenarios:
+            result = run_scenario(
+                client, name, args.requests, args.concurrency)
+            result['peak_rss_mb'] = round(peak_rss_kb(process.pid) / 1024, 1)
+            results.append(result)
+            print('{scenario:8} {ok:6}/{requests} ok {throughput:8} req/s  '
+                  'p50 {p50_ms} ms  p90 {p90_ms} ms  p99 {p99_ms} ms  '
+                  'max {max_ms} ms  peak RSS {peak_rss_mb} MB  '
+                  'errors {errors}'.format(**result))
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        nextcloud.shutdown()
+        nextcloud.server_close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(
+                settings=vars(args),
+                nextcloud_calls=nextcloud.counts,
+                results=results
+            ), f, indent=2)
+
+    # Failed requests are quick and would flatter the numbers above
+    failed = [result for result in results
+              if result['error_rate'] > args.max_error_rate]
+    for result in failed:
+        print('FAILED {scenario}: {error_rate:.1%} of requests failed, '
+              'errors {errors}'.format(**result), file=sys.stderr)
+        for status, sample in sorted(result['error_samples'].items()):
+            print('    {}: {}'.format(status, sample), file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
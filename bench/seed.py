@@ -0,0 +1,209 @@
+"""Create and fill a SQLite stand-in for the Nextcloud database.
+
+Only the tables and columns the server touches are created. Row counts are
+set on the command line; the defaults give a few hundred thousand files.
+
+    python bench/seed.py bench.db --users 20 --files 200000
+"""
+import argparse
+import hashlib
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+SCHEMA = """
+CREATE TABLE oc_users (
+    uid VARCHAR(64) PRIMARY KEY,
+    password VARCHAR(255) NOT NULL DEFAULT ''
+);
+CREATE TABLE oc_storages (
+    numeric_id INTEGER PRIMARY KEY,
+    id VARCHAR(64) NOT NULL UNIQUE
+);
+CREATE TABLE oc_filecache (
+    fileid INTEGER PRIMARY KEY,
+    storage INTEGER NOT NULL,
+    path VARCHAR(4000),
+    path_hash VARCHAR(32) NOT NULL,
+    name VARCHAR(250),
+    mimetype INTEGER NOT NULL DEFAULT 0,
+    size BIGINT NOT NULL DEFAULT 0,
+    etag VARCHAR(40),
+    UNIQUE (storage, path_hash)
+);
+CREATE TABLE oc_systemtag (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(64) NOT NULL DEFAULT '',
+    visibility SMALLINT NOT NULL DEFAULT 1,
+    editable SMALLINT NOT NULL DEFAULT 1
+);
+CREATE TABLE oc_systemtag_object_mapping (
+    objectid INTEGER NOT NULL,
+    objecttype VARCHAR(64) NOT NULL DEFAULT 'files',
+    systemtagid INTEGER NOT NULL,
+    PRIMARY KEY (objecttype, objectid, systemtagid)
+);
+CREATE TABLE datatypes (
+    datatype_id INTEGER PRIMARY KEY,
+    name VARCHAR(64),
+    is_large BOOLEAN NOT NULL DEFAULT 0
+);
+CREATE TABLE devices (
+    device_id INTEGER PRIMARY KEY,
+    name VARCHAR(64),
+    location VARCHAR(64),
+    uid VARCHAR(64) REFERENCES oc_users (uid)
+);
+CREATE TABLE sensors (
+    sensor_id INTEGER PRIMARY KEY,
+    name VARCHAR(64),
+    topic VARCHAR(128),
+    is_enabled BOOLEAN NOT NULL DEFAULT 1,
+    datatype_id INTEGER REFERENCES datatypes (datatype_id),
+    device_id INTEGER REFERENCES devices (device_id)
+);
+CREATE TABLE sensor_files (
+    fileid INTEGER PRIMARY KEY REFERENCES oc_filecache (fileid),
+    upload_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+    sensor_id INTEGER REFERENCES sensors (sensor_id)
+);
+CREATE INDEX ix_sensor_files_sensor ON sensor_files (sensor_id, upload_date);
+CREATE INDEX ix_sensor_files_date ON sensor_files (upload_date, fileid);
+CREATE TABLE sensor_upload_stats (
+    sensor_id INTEGER NOT NULL REFERENCES sensors (sensor_id),
+    bucket DATETIME NOT NULL,
+    file_count INTEGER NOT NULL DEFAULT 0,
+    byte_count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (sensor_id, bucket)
+);
+CREATE TABLE sensor_file_hashes (
+    fileid INTEGER PRIMARY KEY REFERENCES oc_filecache (fileid),
+    sensor_id INTEGER NOT NULL REFERENCES sensors (sensor_id),
+    sha256 CHAR(64) NOT NULL,
+    uploaded_at DATETIME NOT NULL
+);
+CREATE INDEX ix_sensor_file_hashes_lookup
+    ON sensor_file_hashes (sensor_id, sha256, uploaded_at);
+"""
+
+DATATYPES = [('json', 0), ('csv', 0), ('txt', 0), ('xml', 0),
+             ('jpg', 1), ('png', 1)]
+# oc_mimetypes ids as found on a typical instance; listings skip ids <= 2
+MIMETYPES = {'json': 5, 'csv': 6, 'txt': 7, 'xml': 8, 'jpg': 9, 'png': 10}
+
+
+def user_name(index):
+    return 'bench{}'.format(index)
+
+
+def seed(path, users, devices, sensors, files, tags, tags_per_file, seed):
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+
+    connection.executemany(
+        'INSERT INTO oc_users (uid) VALUES (?)',
+        [(user_name(u),) for u in range(users)])
+    connection.executemany(
+        'INSERT INTO oc_storages (numeric_id, id) VALUES (?, ?)',
+        [(u + 1, 'home::' + user_name(u)) for u in range(users)])
+    connection.executemany(
+        'INSERT INTO datatypes (datatype_id, name, is_large) VALUES (?, ?, ?)',
+        [(i + 1, name, large) for i, (name, large) in enumerate(DATATYPES)])
+    connection.executemany(
+        'INSERT INTO oc_systemtag (id, name) VALUES (?, ?)',
+        [(t + 1, 'tag-{}'.format(t)) for t in range(tags)])
+
+    device_rows, sensor_rows = [], []
+    for u in range(users):
+        for d in range(devices):
+            device_id = len(device_rows) + 1
+            device_rows.append((
+                device_id, 'device-{}-{}'.format(u, d),
+                'site-{}'.format(rng.randrange(50)), user_name(u)))
+            for s in range(sensors):
+                sensor_rows.append((
+                    len(sensor_rows) + 1, 'sensor-{}-{}'.format(device_id, s),
+                    'elsdan/{}/{}'.format(device_id, s), 1,
+                    rng.randrange(len(DATATYPES)) + 1, device_id))
+    connection.executemany(
+        'INSERT INTO devices VALUES (?, ?, ?, ?)', device_rows)
+    connection.executemany(
+        'INSERT INTO sensors VALUES (?, ?, ?, ?, ?, ?)', sensor_rows)
+
+    # Files are spread over the last year, oldest first
+    start = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / max(files, 1)
+    batch_files, batch_sensor_files, batch_tags = [], [], []
+    for file_id in range(1, files + 1):
+        sensor = sensor_rows[rng.randrange(len(sensor_rows))]
+        device = device_rows[sensor[5] - 1]
+        storage = int(device[3][len('bench'):]) + 1
+        extension = DATATYPES[sensor[4] - 1][0]
+        name = 'file_{}_sensor_{}.{}'.format(file_id, sensor[0], extension)
+        path = 'files/elsdan/' + name
+        batch_files.append((
+            file_id, storage, path,
+            hashlib.md5(path.encode('utf-8')).hexdigest(), name,
+            MIMETYPES[extension], rng.randrange(200, 200000),
+            '{:032x}'.format(rng.getrandbits(128))))
+        batch_sensor_files.append((
+            file_id, (start + step * file_id).isoformat(' '), sensor[0]))
+        for tag_id in rng.sample(range(1, tags + 1), min(tags_per_file, tags)):
+            batch_tags.append((file_id, 'files', tag_id))
+
+        if len(batch_files) >= 10000 or file_id == files:
+            connection.executemany(
+                'INSERT INTO oc_filecache VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                batch_files)
+            connection.executemany(
+                'INSERT INTO sensor_files VALUES (?, ?, ?)',
+                batch_sensor_files)
+            connection.executemany(
+                'INSERT INTO oc_systemtag_object_mapping VALUES (?, ?, ?)',
+                batch_tags)
+            batch_files, batch_sensor_files, batch_tags = [], [], []
+
+    connection.execute("""
+        INSERT INTO sensor_upload_stats
+        SELECT sf.sensor_id,
+               strftime('%Y-%m-%d %H:00:00.000000', sf.upload_date),
+               count(*), sum(f.size)
+        FROM sensor_files sf JOIN oc_filecache f ON f.fileid = sf.fileid
+        GROUP BY 1, 2
+    """)
+    connection.commit()
+    connection.close()
+    return dict(users=users, devices=len(device_rows),
+                sensors=len(sensor_rows), files=files,
+                tag_mappings=files * min(tags_per_file, tags))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--devices', type=int, default=5,
+                        help='devices per user')
+    parser.add_argument('--sensors', type=int, default=4,
+                        help='sensors per device')
+    parser.add_argument('--files', type=int, default=200000)
+    parser.add_argument('--tags', type=int, default=50)
+    parser.add_argument('--tags-per-file', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    counts = seed(args.path, args.users, args.devices, args.sensors,
+                  args.files, args.tags, args.tags_per_file, args.seed)
+    print('Seeded {} in {:.1f}s: {}'.format(
+        args.path, time.perf_counter() - started, counts))
+
+
+if __name__ == '__main__':
+    main()
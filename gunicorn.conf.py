@@ -0,0 +1,33 @@
+import multiprocessing
+import os
+
+# gevent workers run each request in a green thread. A request waiting on a
+# WebDAV PUT, an OCS login check or MySQL yields to the others instead of
+# holding the whole process, so one worker can carry hundreds of uploads.
+# requests and pymysql are pure Python and become cooperative once the
+# standard library is patched. Set GUNICORN_WORKER_CLASS=sync for plain
+# process-per-request workers.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:80')
+# Clients send headers such as sensor_id. gunicorn is pinned to 20.1 in
+# requirements.txt: from 22.0 on it drops header names with underscores
+# unless told otherwise with header_map.
+timeout = 3600
+# Load the app and its schema once, before forking the workers
+preload_app = True
+
+if worker_class == 'gevent':
+    # Patch before the app is preloaded, so sockets, locks and threads
+    # created at import time are already cooperative
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def post_worker_init(worker):
+    # Replay spooled uploads as soon as the worker is up, rather than
+    # waiting for its first request
+    from app import spool
+    spool.recover()
@@ -0,0 +1,111 @@
+"""Request-level tests against the benchmark stand-ins.
+
+The server runs in-process on a small database seeded by bench/seed.py,
+talking to bench/fake_nextcloud.py over HTTP. Every seeded user's password
+is PASSWORD. Needs the packages of requirements.txt plus pytest:
+
+    python -m pytest tests
+"""
+import base64
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, 'bench')
+sys.path.insert(0, BENCH_DIR)
+
+import fake_nextcloud  # noqa: E402
+import seed  # noqa: E402
+
+PASSWORD = 'bench'
+
+
+@pytest.fixture(scope='session')
+def database(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('db') / 'test.db')
+    seed.seed(path, users=2, devices=2, sensors=2, files=40, tags=5,
+              tags_per_file=1, seed=1)
+    return path
+
+
+@pytest.fixture(scope='session')
+def nextcloud(database):
+    server = fake_nextcloud.serve(database, password=PASSWORD)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope='session')
+def app(database, nextcloud, tmp_path_factory):
+    os.environ.update(
+        ENV_DIRECTORY=os.path.join(BENCH_DIR, 'config.py'),
+        BENCH_DATABASE=database,
+        BENCH_NEXTCLOUD='http://127.0.0.1:{}'.format(
+            nextcloud.server_address[1]),
+        BENCH_SPOOL_DIR=str(tmp_path_factory.mktemp('spool')),
+        DOWNLOAD_CACHE_DIR=str(tmp_path_factory.mktemp('download_cache'))
+    )
+    from app import app
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def db(database):
+    """Plain connection to the test database, for setting up and checking
+    rows behind the server's back"""
+
+    connection = sqlite3.connect(database, timeout=30)
+    yield connection
+    connection.close()
+
+
+def basic_auth(uid, password=PASSWORD):
+    raw = '{}:{}'.format(uid, password).encode('utf-8')
+    return 'Basic ' + base64.b64encode(raw).decode('ascii')
+
+
+@pytest.fixture
+def login(client):
+    """Headers carrying a fresh access token of a seeded user"""
+
+    def login(uid='bench0'):
+        response = client.post(
+            '/login', headers={'Authorization': basic_auth(uid)})
+        assert response.status_code == 200, response.data
+        return {'Authorization': 'Bearer ' + response.json['access_token']}
+    return login
+
+
+@pytest.fixture
+def sensor_of(db):
+    """A sensor id owned by a user"""
+
+    def sensor_of(uid='bench0'):
+        return db.execute(
+            'SELECT s.sensor_id FROM sensors s '
+            'JOIN devices d ON d.device_id = s.device_id '
+            'WHERE d.uid = ? ORDER BY s.sensor_id', (uid,)).fetchone()[0]
+    return sensor_of
+
+
+@pytest.fixture
+def file_of(db):
+    """A seeded file id uploaded to a user's sensor"""
+
+    def file_of(uid='bench0'):
+        return db.execute(
+            'SELECT sf.fileid FROM sensor_files sf '
+            'JOIN sensors s ON s.sensor_id = sf.sensor_id '
+            'JOIN devices d ON d.device_id = s.device_id '
+            'WHERE d.uid = ? ORDER BY sf.fileid', (uid,)).fetchone()[0]
+    return file_of
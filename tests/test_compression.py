@@ -0,0 +1,132 @@
+import gzip
+import os
+
+import pytest
+import requests
+
+from test_dedup import batch, filecache_rows, upload
+
+
+def stored(nextcloud, file_id):
+    with open(os.path.join(nextcloud.data_dir, str(file_id)), 'rb') as f:
+        return f.read()
+
+
+def test_gzip_body_is_stored_decoded(client, login, sensor_of, nextcloud):
+    headers, sensor_id, body = login(), sensor_of(), os.urandom(500)
+    chunked = nextcloud.counts['chunked']
+
+    response = upload(client, headers, sensor_id, gzip.compress(body),
+                      **{'Content-Encoding': 'gzip'})
+    assert response.status_code == 201, response.data
+    assert stored(nextcloud, response.json['file_id']) == body
+    # Its decoded size wasn't known up front, yet it went out with a
+    # Content-Length
+    assert nextcloud.counts['chunked'] == chunked
+
+
+def test_zstd_body_is_stored_decoded(client, login, sensor_of, nextcloud):
+    zstandard = pytest.importorskip('zstandard')
+    headers, sensor_id, body = login(), sensor_of(), os.urandom(500)
+
+    response = upload(client, headers, sensor_id,
+                      zstandard.ZstdCompressor().compress(body),
+                      **{'Content-Encoding': 'zstd'})
+    assert response.status_code == 201, response.data
+    assert stored(nextcloud, response.json['file_id']) == body
+
+
+def test_corrupt_body_is_refused(client, login, sensor_of, db, nextcloud):
+    headers, sensor_id = login(), sensor_of()
+    files, puts = filecache_rows(db), nextcloud.counts['put']
+
+    response = upload(client, headers, sensor_id,
+                      gzip.compress(os.urandom(500))[:-20],
+                      **{'Content-Encoding': 'gzip'})
+    assert response.status_code == 400, response.data
+    assert filecache_rows(db) == files
+    assert nextcloud.counts['put'] == puts
+
+
+def test_chunked_uploads_stream_through(app, client, login, sensor_of, db,
+                                        nextcloud, monkeypatch):
+    monkeypatch.setitem(app.config, 'NEXTCLOUD_CHUNKED_UPLOADS', True)
+    headers, sensor_id, body = login(), sensor_of(), os.urandom(500)
+    chunked = nextcloud.counts['chunked']
+
+    response = upload(client, headers, sensor_id, gzip.compress(body),
+                      **{'Content-Encoding': 'gzip'})
+    assert response.status_code == 201, response.data
+    assert stored(nextcloud, response.json['file_id']) == body
+    assert nextcloud.counts['chunked'] == chunked + 1
+
+    # A body that breaks off part way through the send is still a 400
+    files = filecache_rows(db)
+    response = upload(client, headers, sensor_id,
+                      gzip.compress(os.urandom(500))[:-20],
+                      **{'Content-Encoding': 'gzip'})
+    assert response.status_code == 400, response.data
+    assert filecache_rows(db) == files
+
+
+def test_body_error_wrapped_by_requests_is_a_400(app, client, login,
+                                                 sensor_of, monkeypatch):
+    from app import nextcloud
+
+    def put(url, data=None, **kwargs):
+        try:
+            for _ in data:
+                pass
+        except Exception as e:
+            raise requests.ConnectionError(e)
+
+    monkeypatch.setitem(app.config, 'NEXTCLOUD_CHUNKED_UPLOADS', True)
+    monkeypatch.setattr(nextcloud, 'put', put)
+    response = upload(client, login(), sensor_of(),
+                      gzip.compress(os.urandom(500))[:-20],
+                      **{'Content-Encoding': 'gzip'})
+    assert response.status_code == 400, response.data
+
+
+def test_large_datatype_is_stored_gzipped(app, client, login, sensor_of, db,
+                                          nextcloud, monkeypatch):
+    from app import refdata
+
+    headers, sensor_id = login(), sensor_of()
+    datatype_id = db.execute(
+        'SELECT datatype_id FROM sensors WHERE sensor_id = ?',
+        (sensor_id,)).fetchone()[0]
+    db.execute('UPDATE datatypes SET is_large = 1 WHERE datatype_id = ?',
+               (datatype_id,))
+    db.commit()
+    refdata.datatypes.invalidate()
+    monkeypatch.setitem(app.config, 'STORE_COMPRESSED_DATATYPE_IDS',
+                        [datatype_id])
+
+    def stored_gzipped(file_id, body):
+        path = db.execute('SELECT path FROM oc_filecache WHERE fileid = ?',
+                          (file_id,)).fetchone()[0]
+        return path.endswith('.gz') \
+            and gzip.decompress(stored(nextcloud, file_id)) == body
+
+    body = os.urandom(500)
+    response = upload(client, headers, sensor_id, body)
+    assert response.status_code == 201, response.data
+    assert stored_gzipped(response.json['file_id'], body)
+
+    # Batch parts are stored the same way
+    bodies = [os.urandom(500) for _ in range(2)]
+    for result, body in zip(batch(client, headers, sensor_id, bodies),
+                            bodies):
+        assert result['status'] == 201, result
+        assert result['path'].endswith('.gz')
+        assert stored_gzipped(result['file_id'], body)
+
+    # Renaming the datatype doesn't change how its uploads are stored
+    response = client.patch('/api/datatype', headers=headers, json={
+        'datatype_id': datatype_id, 'datatype_name': 'renamed'})
+    assert response.status_code == 200, response.data
+    body = os.urandom(500)
+    response = upload(client, headers, sensor_id, body)
+    assert response.status_code == 201, response.data
+    assert stored_gzipped(response.json['file_id'], body)
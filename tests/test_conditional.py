@@ -0,0 +1,32 @@
+from decimal import Decimal
+
+from sqlalchemy.dialects import mysql
+
+
+def test_etag_of_mysql_aggregates(app):
+    from app.conditional import make_etag
+
+    # MySQL hands back SUM() as a Decimal
+    assert make_etag('x', (3, Decimal('12'))) == make_etag('x', (3, 12))
+
+
+def test_fingerprint_sums_are_integers(app, monkeypatch):
+    from app import conditional
+    from app.models import SensorFile
+
+    statements = []
+    execute = conditional.db.session.execute
+
+    def capture(statement, *args, **kwargs):
+        statements.append(statement)
+        return execute(statement, *args, **kwargs)
+
+    with app.app_context():
+        monkeypatch.setattr(conditional.db.session, 'execute', capture)
+        result = conditional.fingerprint(
+            conditional.select(SensorFile.file_id),
+            max_of=[SensorFile.file_id], sum_of=[SensorFile.sensor_id])
+
+    assert all(isinstance(value, int) for value in result)
+    sql = str(statements[0].compile(dialect=mysql.dialect()))
+    assert 'CAST(sum(' in sql
@@ -0,0 +1,150 @@
+import hashlib
+import io
+import os
+
+from test_uploads import upload_headers
+
+
+def upload(client, headers, sensor_id, body, **extra):
+    return client.put('/api/file', data=body,
+                      headers=upload_headers(headers, sensor_id, **extra))
+
+
+def filecache_rows(db):
+    return db.execute('SELECT count(*) FROM oc_filecache').fetchone()[0]
+
+
+def test_repeat_upload_returns_earlier_file(client, login, sensor_of, db,
+                                           nextcloud):
+    headers, sensor_id, body = login(), sensor_of(), os.urandom(500)
+    first = upload(client, headers, sensor_id, body)
+    assert first.status_code == 201, first.data
+    files, deletes = filecache_rows(db), nextcloud.counts['delete']
+
+    repeat = upload(client, headers, sensor_id, body, tag_id='3')
+    assert repeat.status_code == 200, repeat.data
+    assert repeat.json['duplicate'] is True
+    file_id = repeat.json['file_id']
+    assert file_id == first.json['file_id']
+
+    # The second copy was sent, then deleted again
+    assert nextcloud.counts['delete'] == deletes + 1
+    assert filecache_rows(db) == files
+    # and the repeat's tag went on the earlier file
+    assert db.execute(
+        'SELECT 1 FROM oc_systemtag_object_mapping '
+        'WHERE objectid = ? AND systemtagid = 3', (file_id,)).fetchone()
+
+
+def test_same_body_on_another_sensor_is_kept(client, login, db):
+    sensors = [sensor_id for sensor_id, in db.execute(
+        'SELECT s.sensor_id FROM sensors s '
+        'JOIN devices d ON d.device_id = s.device_id '
+        "WHERE d.uid = 'bench0' ORDER BY s.sensor_id LIMIT 2")]
+    headers, body = login(), os.urandom(500)
+
+    first = upload(client, headers, sensors[0], body)
+    second = upload(client, headers, sensors[1], body)
+    assert second.status_code == 201, second.data
+    assert second.json['file_id'] != first.json['file_id']
+
+
+def test_sha256_header_must_match_body(client, login, sensor_of, db):
+    headers, sensor_id, body = login(), sensor_of(), os.urandom(500)
+    first = upload(client, headers, sensor_id, body)
+    files = filecache_rows(db)
+
+    # Naming a known hash doesn't stand in for sending the bytes
+    response = upload(client, headers, sensor_id, os.urandom(500),
+                      sha256=hashlib.sha256(body).hexdigest())
+    assert response.status_code == 400, response.data
+    assert filecache_rows(db) == files
+
+    response = upload(client, headers, sensor_id, body,
+                      sha256=hashlib.sha256(body).hexdigest())
+    assert response.json['file_id'] == first.json['file_id']
+
+
+def test_async_upload_checks_sha256(client, login, sensor_of):
+    response = upload(client, login(), sensor_of(), os.urandom(500),
+                      sha256='0' * 64, **{'async': 'true'})
+    assert response.status_code == 400, response.data
+
+
+def test_dedup_before_upload_skips_the_put(app, client, login, sensor_of,
+                                           nextcloud, monkeypatch):
+    monkeypatch.setitem(app.config, 'DEDUP_BEFORE_UPLOAD', True)
+    headers, sensor_id, body = login(), sensor_of(), os.urandom(500)
+    first = upload(client, headers, sensor_id, body)
+    assert first.status_code == 201, first.data
+    puts = nextcloud.counts['put']
+
+    repeat = upload(client, headers, sensor_id, body)
+    assert repeat.json['file_id'] == first.json['file_id']
+    assert nextcloud.counts['put'] == puts
+
+
+def test_missing_hash_table_is_created(app, db):
+    from app import schema
+
+    db.execute('DROP TABLE sensor_file_hashes')
+    db.commit()
+
+    with app.app_context():
+        schema.create_app_tables()
+
+    assert db.execute("SELECT 1 FROM sqlite_master "
+                      "WHERE name = 'sensor_file_hashes'").fetchone()
+
+
+def batch(client, headers, sensor_id, bodies, tag_id=None):
+    extra = {} if tag_id is None else {'tag_id': str(tag_id)}
+    response = client.post(
+        '/api/file/batch',
+        data={'file': [(io.BytesIO(body), 'part{}.txt'.format(i))
+                       for i, body in enumerate(bodies)]},
+        headers=dict(headers, sensor_id=str(sensor_id), path='sensor-data',
+                     user='bench0', password='bench', **extra))
+    assert response.status_code == 200, response.data
+    return response.json['results']
+
+
+def hash_rows(db, file_id):
+    return db.execute('SELECT count(*) FROM sensor_file_hashes '
+                      'WHERE fileid = ?', (file_id,)).fetchone()[0]
+
+
+def test_repeat_batch_returns_earlier_files(client, login, sensor_of, db,
+                                           nextcloud):
+    headers, sensor_id, body = login(), sensor_of(), os.urandom(500)
+    first, = batch(client, headers, sensor_id, [body])
+    assert first['status'] == 201
+    assert hash_rows(db, first['file_id']) == 1
+    puts, files = nextcloud.counts['put'], filecache_rows(db)
+
+    # Replayed by a gateway, with a tag this time, and a repeat within the
+    # batch
+    repeat = batch(client, headers, sensor_id, [body, body], tag_id=3)
+    assert [(r['status'], r['file_id'], r.get('duplicate')) for r in repeat] \
+        == [(200, first['file_id'], True)] * 2
+    assert nextcloud.counts['put'] == puts
+    assert filecache_rows(db) == files
+    assert db.execute(
+        'SELECT 1 FROM oc_systemtag_object_mapping '
+        'WHERE objectid = ? AND systemtagid = 3',
+        (first['file_id'],)).fetchone()
+
+    # and a PUT of the same body is caught as well
+    response = upload(client, headers, sensor_id, body)
+    assert response.json['file_id'] == first['file_id']
+
+
+def test_repeat_within_one_batch_is_stored_once(client, login, sensor_of,
+                                               nextcloud):
+    headers, body = login(), os.urandom(500)
+    puts = nextcloud.counts['put']
+    results = batch(client, headers, sensor_of(), [body, body])
+    assert [r['status'] for r in results] == [201, 200]
+    assert results[1]['duplicate'] is True
+    assert results[1]['file_id'] == results[0]['file_id']
+    assert nextcloud.counts['put'] == puts + 1
@@ -0,0 +1,84 @@
+import os
+
+from test_dedup import upload
+
+
+def download(client, headers, file_id, uid='bench0', **extra):
+    response = client.get('/api/file/{}'.format(file_id),
+                          headers=dict(headers, user=uid, password='bench',
+                                       **extra))
+    # Read streamed bodies now, before the next request
+    response.get_data()
+    return response
+
+
+def uploaded(client, headers, sensor_id, size=1000):
+    body = os.urandom(size)
+    response = upload(client, headers, sensor_id, body)
+    assert response.status_code == 201, response.data
+    return response.json['file_id'], body
+
+
+def test_download_is_cached(client, login, sensor_of, nextcloud):
+    headers = login()
+    file_id, body = uploaded(client, headers, sensor_of())
+    gets = nextcloud.counts['get']
+
+    first = download(client, headers, file_id)
+    assert first.status_code == 200
+    assert first.headers['X-Cache'] == 'MISS'
+    assert first.data == body
+
+    repeat = download(client, headers, file_id)
+    assert repeat.status_code == 200
+    assert repeat.headers['X-Cache'] == 'HIT'
+    assert repeat.data == body
+    assert nextcloud.counts['get'] == gets + 1
+
+
+def test_range_and_conditional_get(client, login, sensor_of):
+    headers = login()
+    file_id, body = uploaded(client, headers, sensor_of())
+
+    # From Nextcloud, then from the cached copy
+    for cache in ('MISS', 'HIT'):
+        response = download(client, headers, file_id, Range='bytes=10-19')
+        assert response.status_code == 206
+        assert response.headers['X-Cache'] == cache
+        assert response.data == body[10:20]
+        download(client, headers, file_id)
+
+    etag = download(client, headers, file_id).headers['ETag']
+    response = download(client, headers, file_id, **{'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_other_users_file_is_refused(client, login, sensor_of):
+    file_id, _ = uploaded(client, login(), sensor_of())
+    response = download(client, login('bench1'), file_id, uid='bench1')
+    assert response.status_code == 403
+
+
+def test_cache_lookups_on_metrics(client, login, sensor_of):
+    headers = login()
+    file_id, _ = uploaded(client, headers, sensor_of())
+    download(client, headers, file_id)
+    download(client, headers, file_id)
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE elsdan_download_cache_lookups_total counter' in text
+    assert 'elsdan_download_cache_lookups_total{result="hit"}' in text
+    assert 'elsdan_download_cache_lookups_total{result="miss"}' in text
+
+
+def test_least_recently_used_copy_is_evicted(app, client, login, sensor_of,
+                                             monkeypatch):
+    monkeypatch.setitem(app.config, 'DOWNLOAD_CACHE_MAX_BYTES', 1500)
+    headers, sensor_id = login(), sensor_of()
+    first, _ = uploaded(client, headers, sensor_id)
+    second, _ = uploaded(client, headers, sensor_id)
+
+    download(client, headers, first)
+    download(client, headers, second)
+    assert download(client, headers, second).headers['X-Cache'] == 'HIT'
+    assert download(client, headers, first).headers['X-Cache'] == 'MISS'
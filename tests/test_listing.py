@@ -0,0 +1,82 @@
+def test_login_rejects_wrong_password(client):
+    from conftest import basic_auth
+
+    response = client.post(
+        '/login', headers={'Authorization': basic_auth('bench0', 'wrong')})
+    assert response.status_code == 401
+
+
+def test_filedetail_lists_own_files(client, login):
+    response = client.get('/api/filedetail', headers=login())
+    assert response.status_code == 200
+    rows = response.json
+    assert rows
+    for row in rows:
+        assert {'file_id', 'file_name', 'sensor_id', 'tags'} <= set(row)
+
+
+def test_filedetail_pages_with_cursor(client, login):
+    headers = login()
+    first = client.get('/api/filedetail?limit=5', headers=headers)
+    assert first.status_code == 200
+    seen = {row['file_id'] for row in first.json}
+    cursor = first.headers['X-Next-Cursor']
+
+    second = client.get(
+        '/api/filedetail?limit=5&cursor=' + cursor, headers=headers)
+    assert second.status_code == 200
+    assert not seen & {row['file_id'] for row in second.json}
+
+
+def test_filedetail_answers_conditional_get(client, login):
+    headers = login()
+    response = client.get('/api/filedetail', headers=headers)
+    assert response.json
+    etag = response.headers['ETag']
+
+    again = client.get(
+        '/api/filedetail', headers=dict(headers, **{'If-None-Match': etag}))
+    assert again.status_code == 304
+
+
+def test_create_indexes_adds_filedetail_index(app, db):
+    db.execute('DROP INDEX ix_sensor_files_date')
+    db.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['create-indexes'])
+    assert result.exit_code == 0, result.output
+    assert 'Created ix_sensor_files_date' in result.output
+    assert db.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'ix_sensor_files_date'"
+    ).fetchone()[0].endswith('(upload_date, fileid)')
+
+    # Nothing left to do the second time
+    assert runner.invoke(args=['create-indexes']).output == ''
+
+
+def test_bulk_post_returns_new_ids(client, login, db):
+    headers = login()
+    response = client.post('/api/device', headers=headers, json=[
+        {'device_name': 'bulk-{}'.format(i), 'location': 'lab'}
+        for i in range(3)])
+    assert response.status_code == 200, response.data
+    device_ids = [result['device_id'] for result in response.json['results']]
+    assert [db.execute('SELECT name FROM devices WHERE device_id = ?',
+                       (device_id,)).fetchone()[0]
+            for device_id in device_ids] == ['bulk-0', 'bulk-1', 'bulk-2']
+
+    response = client.post('/api/sensor', headers=headers, json=[
+        {'sensor_name': 'bulk-a', 'datatype_id': 1,
+         'device_id': device_ids[0]},
+        {'sensor_name': 'bulk-b', 'datatype_id': 1, 'device_id': 10 ** 6},
+        {'sensor_name': 'bulk-c', 'datatype_id': 1,
+         'device_id': device_ids[1]}])
+    assert response.status_code == 200, response.data
+    results = response.json['results']
+    assert [result['status'] for result in results] == [201, 400, 201]
+    assert 'sensor_id' not in results[1]
+    for result, device_id in ((results[0], device_ids[0]),
+                              (results[2], device_ids[1])):
+        assert db.execute('SELECT device_id FROM sensors WHERE sensor_id = ?',
+                          (result['sensor_id'],)).fetchone()[0] == device_id
@@ -0,0 +1,68 @@
+import pytest
+
+
+@pytest.fixture
+def fresh_backend(monkeypatch):
+    from app import search
+
+    # Pick the backend again after the indexes change
+    monkeypatch.setattr(search, '_backend', None)
+
+
+def nextcloud_triggers(db):
+    return db.execute(
+        "SELECT name FROM sqlite_master "
+        "WHERE type = 'trigger' AND tbl_name = 'oc_systemtag'").fetchall()
+
+
+def found(client, login, q, kind):
+    response = client.get('/api/search?q={}&kind={}'.format(q, kind),
+                          headers=login())
+    assert response.status_code == 200, response.data
+    return {(result['kind'], result['name']) for result in response.json}
+
+
+def test_search_indexes_leave_nextcloud_tables_alone(
+        app, client, login, db, fresh_backend):
+    result = app.test_cli_runner().invoke(args=['create-search-indexes'])
+    assert result.exit_code == 0, result.output
+    assert not nextcloud_triggers(db)
+
+    # Sensors come from the full-text table, tags from LIKE
+    sensor_name = db.execute(
+        'SELECT s.name FROM sensors s '
+        'JOIN devices d ON d.device_id = s.device_id '
+        "WHERE d.uid = 'bench0' LIMIT 1").fetchone()[0]
+    assert ('sensor', sensor_name) in found(client, login, sensor_name,
+                                            'sensor')
+    assert ('tag', 'tag-1') in found(client, login, 'tag-1', 'tag')
+
+
+def test_search_indexes_on_nextcloud_tables_when_asked(
+        app, client, login, db, fresh_backend):
+    result = app.test_cli_runner().invoke(
+        args=['create-search-indexes', '--nextcloud-tables'])
+    assert result.exit_code == 0, result.output
+    assert 'Warning' in result.output
+    assert nextcloud_triggers(db)
+    assert ('tag', 'tag-1') in found(client, login, 'tag', 'tag')
+
+
+def test_search_ranks_matches_alike_across_backends(
+        app, client, login, db, fresh_backend):
+    result = app.test_cli_runner().invoke(args=['create-search-indexes'])
+    assert result.exit_code == 0, result.output
+
+    # Devices are found through the full-text table, tags with LIKE
+    db.executemany("INSERT INTO devices (name, location, uid) "
+                   "VALUES (?, 'lab', 'bench0')",
+                   [('old pump',), ('pump',)])
+    db.execute("INSERT INTO oc_systemtag (name) VALUES ('pumps and valves')")
+    db.commit()
+
+    response = client.get('/api/search?q=pump&kind=device,tag',
+                          headers=login())
+    assert response.status_code == 200, response.data
+    assert [(result['kind'], result['name']) for result in response.json] \
+        == [('device', 'pump'), ('tag', 'pumps and valves'),
+            ('device', 'old pump')]
@@ -0,0 +1,57 @@
+import fcntl
+import os
+
+import requests
+
+from test_uploads import upload_headers
+
+
+def spooled(app, job_id, suffix):
+    return os.path.join(app.config['UPLOAD_SPOOL_DIR'], job_id + suffix)
+
+
+def test_outage_never_fails_a_job(app, client, login, sensor_of,
+                                  monkeypatch):
+    from app import nextcloud, spool
+
+    queued = []
+    monkeypatch.setattr(spool, 'submit', queued.append)
+    monkeypatch.setattr(spool, '_retry_later', lambda job_id, attempts: None)
+    response = client.put(
+        '/api/file', data=os.urandom(1000),
+        headers=upload_headers(login(), sensor_of(), **{'async': 'true'}))
+    assert response.status_code == 202, response.data
+    job_id = queued[0]
+
+    def unreachable(url, **kwargs):
+        raise requests.ConnectionError('Nextcloud is down')
+
+    monkeypatch.setattr(nextcloud, 'put', unreachable)
+    for _ in range(50):
+        spool.run_job(job_id)
+    job = spool.get_job(job_id)
+    assert job['state'] == 'queued'
+    assert job['attempts'] == 50
+    assert os.path.exists(spooled(app, job_id, '.data'))
+
+    # Once it is back, the job goes through
+    monkeypatch.undo()
+    spool.run_job(job_id)
+    assert spool.get_job(job_id)['state'] == 'done'
+
+
+def test_recover_removes_orphaned_parts(app, monkeypatch):
+    from app import spool
+
+    monkeypatch.setattr(spool, '_recovered_pid', None)
+    monkeypatch.setattr(spool, 'submit', lambda job_id: None)
+    orphan = spooled(app, 'orphan', '.part')
+    busy = spooled(app, 'busy', '.part')
+    open(orphan, 'wb').close()
+    with open(busy, 'wb') as f:
+        # Still being written by another worker
+        fcntl.flock(f, fcntl.LOCK_EX)
+        spool.recover()
+    assert not os.path.exists(orphan)
+    assert os.path.exists(busy)
+    os.remove(busy)
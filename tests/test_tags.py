@@ -0,0 +1,116 @@
+def file_tags(db, file_id):
+    return {tag_id for tag_id, in db.execute(
+        "SELECT systemtagid FROM oc_systemtag_object_mapping "
+        "WHERE objectid = ? AND objecttype = 'files'", (file_id,))}
+
+
+def unused_tag(db, file_id):
+    return next(tag_id for tag_id, in db.execute(
+        'SELECT id FROM oc_systemtag ORDER BY id')
+        if tag_id not in file_tags(db, file_id))
+
+
+def test_filedetail_put_tags_a_file(client, login, db, file_of):
+    file_id = file_of()
+    tag_id = unused_tag(db, file_id)
+    headers = login()
+
+    response = client.put('/api/filedetail', headers=headers,
+                          json={'file_id': file_id, 'tag_id': tag_id})
+    assert response.status_code == 200, response.data
+    assert tag_id in file_tags(db, file_id)
+
+    # Tagging it again changes nothing
+    response = client.put('/api/filedetail', headers=headers,
+                          json={'file_id': file_id, 'tag_id': tag_id})
+    assert response.status_code == 200, response.data
+
+    listed = client.get('/api/filedetail?file_id={}'.format(file_id),
+                        headers=headers).json
+    assert tag_id in [tag['tag_id'] for tag in listed[0]['tags']]
+
+    response = client.delete('/api/filedetail', headers=headers,
+                             json={'file_id': file_id, 'tag_id': tag_id})
+    assert response.status_code == 200, response.data
+    assert tag_id not in file_tags(db, file_id)
+
+
+def test_filedetail_names_tags_made_elsewhere(client, login, db, file_of):
+    file_id, headers = file_of(), login()
+    # Loads the tag cache of this worker
+    assert client.get('/api/tag', headers=headers).status_code == 200
+
+    # A tag made by another worker, or by Nextcloud itself
+    tag_id = db.execute('INSERT INTO oc_systemtag (name) VALUES (?)',
+                        ('made, elsewhere: \u00e9',)).lastrowid
+    db.execute("INSERT INTO oc_systemtag_object_mapping VALUES (?, 'files', ?)",
+               (file_id, tag_id))
+    db.commit()
+
+    listed = client.get('/api/filedetail?file_id={}'.format(file_id),
+                        headers=headers).json
+    assert dict(tag_id=tag_id, tag_name='made, elsewhere: \u00e9') \
+        in listed[0]['tags']
+
+
+def test_filedetail_put_rejects_unknown_tag(client, login, file_of):
+    response = client.put('/api/filedetail', headers=login(),
+                          json={'file_id': file_of(), 'tag_id': 10 ** 6})
+    assert response.status_code == 404
+
+
+def test_bulk_tagging_by_file_ids(client, login, db):
+    file_ids = [file_id for file_id, in db.execute(
+        'SELECT sf.fileid FROM sensor_files sf '
+        'JOIN sensors s ON s.sensor_id = sf.sensor_id '
+        'JOIN devices d ON d.device_id = s.device_id '
+        "WHERE d.uid = 'bench0' ORDER BY sf.fileid LIMIT 3")]
+    tag_id = unused_tag(db, file_ids[0])
+    db.execute('DELETE FROM oc_systemtag_object_mapping WHERE systemtagid = ?',
+               (tag_id,))
+    db.execute("INSERT INTO oc_systemtag_object_mapping VALUES (?, 'files', ?)",
+               (file_ids[0], tag_id))
+    db.commit()
+    headers = login()
+
+    response = client.put('/api/filedetail/tags', headers=headers,
+                          json={'tag_id': tag_id, 'file_ids': file_ids})
+    assert response.status_code == 200, response.data
+    # The first file already had it
+    assert response.json['files_changed'] == 2
+    for file_id in file_ids:
+        assert tag_id in file_tags(db, file_id)
+
+    response = client.delete('/api/filedetail/tags', headers=headers,
+                             json={'tag_id': tag_id, 'file_ids': file_ids})
+    assert response.status_code == 200, response.data
+    assert response.json['files_changed'] == 3
+
+
+def test_bulk_tagging_by_has_tag_id(client, login, db):
+    # Of three files carrying tag 4, one has tag 5 as well. Adding tag 5 to
+    # every file with tag 4 must skip that one.
+    file_ids = [file_id for file_id, in db.execute(
+        'SELECT sf.fileid FROM sensor_files sf '
+        'JOIN sensors s ON s.sensor_id = sf.sensor_id '
+        'JOIN devices d ON d.device_id = s.device_id '
+        "WHERE d.uid = 'bench0' ORDER BY sf.fileid DESC LIMIT 3")]
+    db.execute('DELETE FROM oc_systemtag_object_mapping '
+               'WHERE systemtagid IN (4, 5)')
+    db.executemany(
+        "INSERT INTO oc_systemtag_object_mapping VALUES (?, 'files', ?)",
+        [(file_id, 4) for file_id in file_ids] + [(file_ids[0], 5)])
+    db.commit()
+
+    response = client.put('/api/filedetail/tags', headers=login(),
+                          json={'tag_id': 5, 'has_tag_id': 4})
+    assert response.status_code == 200, response.data
+    assert response.json['files_changed'] == 2
+    for file_id in file_ids:
+        assert 5 in file_tags(db, file_id)
+
+
+def test_bulk_tagging_needs_a_filter(client, login):
+    response = client.put('/api/filedetail/tags', headers=login(),
+                          json={'tag_id': 1})
+    assert response.status_code == 400
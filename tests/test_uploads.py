@@ -0,0 +1,200 @@
+import io
+import json
+import os
+import time
+
+
+def upload_headers(headers, sensor_id, uid='bench0', **extra):
+    extra.setdefault('path', 'sensor-data')
+    return dict(headers, sensor_id=str(sensor_id), extension='txt',
+                user=uid, password='bench', **extra)
+
+
+def hour_stats(db, sensor_id):
+    return db.execute(
+        'SELECT coalesce(sum(file_count), 0), coalesce(sum(byte_count), 0) '
+        'FROM sensor_upload_stats WHERE sensor_id = ?',
+        (sensor_id,)).fetchone()
+
+
+def test_upload_records_file_and_rollup(client, login, sensor_of, db):
+    sensor_id = sensor_of()
+    files, size = hour_stats(db, sensor_id)
+    body = os.urandom(1000)
+
+    response = client.put('/api/file', data=body,
+                          headers=upload_headers(login(), sensor_id))
+    assert response.status_code == 201, response.data
+    file_id = response.json['file_id']
+
+    assert db.execute('SELECT sensor_id FROM sensor_files WHERE fileid = ?',
+                      (file_id,)).fetchone() == (sensor_id,)
+    assert hour_stats(db, sensor_id) == (files + 1, size + len(body))
+
+
+def test_upload_rejects_other_users_sensor(client, login, sensor_of):
+    response = client.put(
+        '/api/file', data=b'x',
+        headers=upload_headers(login(), sensor_of('bench1')))
+    assert response.status_code == 403
+
+
+def wait_for_job(client, headers, job_id):
+    deadline = time.monotonic() + 10
+    while True:
+        job = client.get('/api/file/job?job_id=' + job_id,
+                         headers=headers).json
+        if job['state'] in ('done', 'failed') \
+                or time.monotonic() > deadline:
+            return job
+        time.sleep(0.05)
+
+
+def test_async_upload_finishes(client, login, sensor_of):
+    headers = login()
+    response = client.put(
+        '/api/file', data=os.urandom(1000),
+        headers=upload_headers(headers, sensor_of(), **{'async': 'true'}))
+    assert response.status_code == 202, response.data
+
+    job = wait_for_job(client, headers, response.json['job']['job_id'])
+    assert job['state'] == 'done', job.get('error')
+    assert job['file_id']
+
+
+def test_spooled_job_keeps_password_encrypted(app, client, login, sensor_of,
+                                              monkeypatch):
+    from app import spool
+
+    queued = []
+    monkeypatch.setattr(spool, 'submit', queued.append)
+    headers = login()
+    for _ in range(2):
+        response = client.put(
+            '/api/file', data=os.urandom(1000),
+            headers=upload_headers(headers, sensor_of(), **{'async': 'true'}))
+        assert response.status_code == 202, response.data
+
+    for job_id in queued:
+        with open(os.path.join(app.config['UPLOAD_SPOOL_DIR'],
+                               job_id + '.json')) as f:
+            saved = f.read()
+        assert 'password' not in saved
+        assert spool.open_credentials(json.loads(saved)['credentials']) \
+            == ('bench0', 'bench')
+
+    spool.run_job(queued[0])
+    assert wait_for_job(client, headers, queued[0])['state'] == 'done'
+
+    # Sealed under another secret, e.g. after a restart with a new one
+    monkeypatch.setitem(app.config, 'JWT_SECRET_KEY', 'another secret')
+    spool.run_job(queued[1])
+    job = spool.get_job(queued[1])
+    assert job['state'] == 'failed'
+    assert 'JWT_SECRET_KEY' in job['error']
+
+
+def test_batch_upload(client, login, sensor_of):
+    headers = login()
+    response = client.post(
+        '/api/file/batch',
+        data={'file': [(io.BytesIO(os.urandom(100)), 'a.txt'),
+                       (io.BytesIO(os.urandom(100)), 'b.csv'),
+                       (io.BytesIO(b'x'), 'c.exe')]},
+        headers=dict(headers, sensor_id=str(sensor_of()),
+                     path='sensor-data', user='bench0', password='bench'))
+    assert response.status_code == 200, response.data
+    statuses = [result['status'] for result in response.json['results']]
+    assert statuses == [201, 201, 400]
+
+
+def test_uploads_in_one_second_keep_their_files(client, login, sensor_of,
+                                                nextcloud):
+    headers, sensor_id = login(), sensor_of()
+    bodies = [os.urandom(100) for _ in range(2)]
+    file_ids = []
+    for body in bodies:
+        response = client.put(
+            '/api/file', data=body,
+            headers=upload_headers(headers, sensor_id, path='same'))
+        assert response.status_code == 201, response.data
+        file_ids.append(response.json['file_id'])
+    response = client.post(
+        '/api/file/batch',
+        data={'file': [(io.BytesIO(os.urandom(100)), 'a.txt')]},
+        headers=dict(headers, sensor_id=str(sensor_id), path='same',
+                     user='bench0', password='bench'))
+    file_ids.append(response.json['results'][0]['file_id'])
+
+    assert len(set(file_ids)) == 3
+    for file_id, body in zip(file_ids, bodies):
+        with open(os.path.join(nextcloud.data_dir, str(file_id)), 'rb') as f:
+            assert f.read() == body
+
+
+def test_batch_transfers_are_timed_on_the_request(client, login, sensor_of):
+    from app import metrics
+
+    def background():
+        # Spooled uploads are timed there too
+        counts = metrics.histograms.snapshot().get(
+            (metrics.BACKGROUND, 'webdav'))
+        return counts[-2] if counts else 0
+
+    before = background()
+    response = client.post(
+        '/api/file/batch',
+        data={'file': [(io.BytesIO(os.urandom(100)), 'a.txt')]},
+        headers=dict(login(), sensor_id=str(sensor_of()),
+                     path='sensor-data', user='bench0', password='bench'))
+    assert response.status_code == 200, response.data
+    assert ('POST /api/file/batch', 'webdav') in \
+        metrics.histograms.snapshot()
+    assert background() == before
+
+
+def test_moving_a_file_moves_its_rollup(client, login, db, file_of):
+    file_id = file_of()
+    source, size = db.execute(
+        'SELECT sf.sensor_id, f.size FROM sensor_files sf '
+        'JOIN oc_filecache f ON f.fileid = sf.fileid WHERE sf.fileid = ?',
+        (file_id,)).fetchone()
+    target = db.execute(
+        'SELECT s.sensor_id FROM sensors s '
+        'JOIN devices d ON d.device_id = s.device_id '
+        'WHERE d.uid = ? AND s.sensor_id != ? ORDER BY s.sensor_id',
+        ('bench0', source)).fetchone()[0]
+    before = hour_stats(db, source), hour_stats(db, target)
+
+    response = client.put('/api/filedetail', headers=login(),
+                          json={'file_id': file_id, 'sensor_id': target})
+    assert response.status_code == 200, response.data
+
+    assert hour_stats(db, source) == (before[0][0] - 1, before[0][1] - size)
+    assert hour_stats(db, target) == (before[1][0] + 1, before[1][1] + size)
+
+
+def test_sensor_stats(client, login, sensor_of):
+    response = client.get('/api/sensor/stats?interval=total&sensor_ids={}'
+                          .format(sensor_of()), headers=login())
+    assert response.status_code == 200, response.data
+    assert response.json[0]['file_count'] > 0
+
+
+def test_missing_rollup_table_is_created_then_backfilled(app, db):
+    from app import schema
+
+    db.execute('DROP TABLE sensor_upload_stats')
+    db.commit()
+
+    with app.app_context():
+        schema.create_app_tables()
+    # Created empty; filling it is left to the command
+    assert db.execute('SELECT count(*) FROM sensor_upload_stats')\
+        .fetchone()[0] == 0
+
+    result = app.test_cli_runner().invoke(args=['backfill-upload-stats'])
+    assert result.exit_code == 0, result.output
+    files = db.execute('SELECT count(*) FROM sensor_files').fetchone()[0]
+    assert db.execute('SELECT sum(file_count) FROM sensor_upload_stats')\
+        .fetchone()[0] == files